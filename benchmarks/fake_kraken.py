@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import asyncio
+import datetime
+import random
+import re
+import time
+
+from aiohttp import web
+
+BATCH_FIELD = re.compile(r"(\w+): (electricityMeterReadings|gasMeterReadings)\(accountNumber: \$(\w+), meterId: \$(\w+), first: (\d+)\)")
+
+TOKEN_LIFETIME = 3600
+REFRESH_LIFETIME = 7 * 24 * 3600
+
+
+class FakeKraken:
+    """A local stand-in for the Kraken GraphQL API, serving made up accounts,
+    meters and daily readings with configurable latency and error rate.
+    Automatic Persisted Queries and compressed responses can be turned off
+    to compare against a server without them."""
+
+    def __init__(self, accounts: int = 2, electricity_meters: int = 2, gas_meters: int = 1, readings: int = 365, latency: float = 0.02, latency_jitter: float = 0.01, error_rate: float = 0.0, seed: int = 1, persisted_queries: bool = True, compression: bool = True):
+        self.accounts = ["A-" + str(1000 + index) for index in range(accounts)]
+        self.electricity_meters = electricity_meters
+        self.gas_meters = gas_meters
+        self.readings = readings
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.persisted_queries = persisted_queries
+        self.compression = compression
+        self.documents = {}
+
+        self.requests = 0
+        self.operations = {}
+        self.url = None
+        self.__runner = None
+
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/graphql/", self.handle)
+
+        self.__runner = web.AppRunner(app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, host, port)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = "http://" + host + ":" + str(port) + "/v1/graphql/"
+        return self.url
+
+
+    async def stop(self):
+        if self.__runner != None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+
+    def reset_counters(self):
+        self.requests = 0
+        self.operations = {}
+
+
+    def meters(self, account_number: str) -> list:
+        found = []
+        for index in range(self.electricity_meters):
+            found.append(("electricity", account_number + "-E" + str(index)))
+        for index in range(self.gas_meters):
+            found.append(("gas", account_number + "-G" + str(index)))
+        return found
+
+
+    def reading(self, meter_id: str, index: int) -> dict:
+        # Index 0 is the newest reading, one per day going back
+        read_at = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) - datetime.timedelta(days=index)
+        value = (self.readings - index) * 9.5
+        return {
+            "id": meter_id + "-R" + str(self.readings - index),
+            "readAt": read_at.isoformat(),
+            "readingSource": "smart",
+            "registers": [{"name": "Standard", "value": "%.3f" % value, "__typename": "RegisterType"}],
+            "source": "SMART",
+            "__typename": "MeterReadingType"
+        }
+
+
+    def readings_page(self, meter_id: str, cursor: str, first: int) -> dict:
+        start = int(cursor) if cursor else 0
+        end = min(start + first, self.readings)
+        return {
+            "edges": [{"node": self.reading(meter_id, index), "__typename": "Edge"} for index in range(start, end)],
+            "pageInfo": {"endCursor": str(end), "hasNextPage": end < self.readings, "__typename": "PageInfoType"},
+            "__typename": "Connection"
+        }
+
+
+    def token(self) -> dict:
+        now = int(time.time())
+        return {
+            "obtainKrakenToken": {
+                "payload": {"iat": now, "exp": now + TOKEN_LIFETIME},
+                "refreshExpiresIn": now + REFRESH_LIFETIME,
+                "refreshToken": "refresh-" + str(now),
+                "token": "token-" + str(now),
+                "__typename": "ObtainJSONWebToken"
+            }
+        }
+
+
+    def account_numbers(self) -> dict:
+        return {
+            "viewer": {
+                "accounts": [{"number": number, "id": number, "balance": 0, "__typename": "AccountType"} for number in self.accounts],
+                "id": "viewer",
+                "preferredName": "Benchmark",
+                "__typename": "AccountUserType"
+            }
+        }
+
+
+    def properties(self, account_number: str) -> dict:
+        electricity = []
+        gas = []
+        for meter_type, meter_id in self.meters(account_number):
+            point = {
+                "id": meter_id + "-P",
+                "meters": [{"id": meter_id, "serialNumber": "S" + meter_id, "activeTo": None, "registers": [{"id": "1", "name": "Standard"}]}]
+            }
+            (electricity if meter_type == "electricity" else gas).append(point)
+
+        return {"properties": [{"id": account_number + "-H", "postcode": "AB1 2CD", "electricityMeterPoints": electricity, "gasMeterPoints": gas}]}
+
+
+    def batch(self, query: str, variables: dict) -> dict:
+        data = {}
+        for alias, field, account_variable, meter_variable, first in BATCH_FIELD.findall(query):
+            data[alias] = self.readings_page(variables[meter_variable], "", int(first))
+        return data
+
+
+    async def handle(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        operation = payload.get("operationName")
+        variables = payload.get("variables") or {}
+
+        self.requests += 1
+        self.operations[operation] = self.operations.get(operation, 0) + 1
+
+        await asyncio.sleep(max(self.latency + self.random.uniform(-self.latency_jitter, self.latency_jitter), 0))
+
+        if self.random.random() < self.error_rate:
+            return web.Response(status=503)
+
+        query = payload.get("query")
+        persisted = (payload.get("extensions") or {}).get("persistedQuery")
+        if query == None and persisted != None:
+            if self.persisted_queries == False:
+                return self.respond(request, {"data": None, "errors": [{"message": "PersistedQueryNotSupported"}]})
+            query = self.documents.get(persisted.get("sha256Hash"))
+            if query == None:
+                return self.respond(request, {"data": None, "errors": [{"message": "PersistedQueryNotFound", "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"}}]})
+        elif query != None and persisted != None and self.persisted_queries == True:
+            self.documents[persisted.get("sha256Hash")] = query
+
+        if operation in ("loginEmailAuthentication", "refreshToken"):
+            data = self.token()
+        elif operation == "headerGetLoggedInUser":
+            data = self.account_numbers()
+        elif operation == "getAccountMeterSelector":
+            data = self.properties(variables['accountNumber'])
+        elif operation in ("meterReadingsHistoryTableElectricityReadings", "meterReadingsHistoryTableGasReadings"):
+            data = {"readings": self.readings_page(variables['meterId'], variables.get("cursor"), variables.get("first", 12))}
+        elif operation == "batchMeterReadings":
+            data = self.batch(query or "", variables)
+        else:
+            return self.respond(request, {"data": None, "errors": [{"message": "Unknown operation " + str(operation)}]})
+
+        return self.respond(request, {"data": data})
+
+
+    def respond(self, request: web.Request, body: dict) -> web.Response:
+        response = web.json_response(body)
+        if self.compression == True:
+            response.enable_compression()
+        return response
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Benchmark the Eon Next client against a local fake Kraken API.
+
+Run from the repository root:
+
+    python -m benchmarks.run --accounts 5 --readings 730
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import time
+import tracemalloc
+
+import aiohttp
+
+from eon_next_library import load_library
+from .fake_kraken import FakeKraken
+
+eonnext = load_library("eonnext")
+transport = load_library("transport")
+
+
+def percentile(values: list, percent: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+class Recorder:
+    """Times every HTTP request a session makes."""
+
+    def __init__(self):
+        self.latencies = []
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_start.append(self.__on_request_start)
+        self.trace_config.on_request_end.append(self.__on_request_end)
+        self.trace_config.on_request_exception.append(self.__on_request_end)
+
+
+    async def __on_request_start(self, session, context, params):
+        context.started = time.perf_counter()
+
+
+    async def __on_request_end(self, session, context, params):
+        self.latencies.append(time.perf_counter() - context.started)
+
+
+def transferred(api) -> tuple:
+    operations = api.metrics.operations.values()
+    return sum(metrics.bytes_sent for metrics in operations), sum(metrics.bytes_received for metrics in operations)
+
+
+def decode_time(api) -> float:
+    # Parsing responses and turning them into models, apart from the wait
+    return sum(metrics.decode_time for metrics in api.metrics.operations.values())
+
+
+async def measure(name: str, server: FakeKraken, recorder: Recorder, api, coroutine, trace_memory: bool = True) -> dict:
+    server.reset_counters()
+    recorder.latencies = []
+    sent, received = transferred(api)
+    decoded = decode_time(api)
+
+    # Tracing allocations slows everything down, decoding most of all
+    peak = 0
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await coroutine
+    wall = time.perf_counter() - started
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    total_sent, total_received = transferred(api)
+
+    return {
+        "scenario": name,
+        "requests": server.requests,
+        "wall_ms": wall * 1000,
+        "p50_ms": percentile(recorder.latencies, 50) * 1000,
+        "p99_ms": percentile(recorder.latencies, 99) * 1000,
+        "decode_ms": (decode_time(api) - decoded) * 1000,
+        "sent_kib": (total_sent - sent) / 1024,
+        "received_kib": (total_received - received) / 1024,
+        "peak_kib": peak / 1024
+    }
+
+
+async def sync_history(api, page_size: int) -> int:
+    async def drain(meter) -> int:
+        count = 0
+        async for reading in meter.iter_readings(page_size):
+            count += 1
+        return count
+
+    return sum(await asyncio.gather(*[drain(meter) for meter in api.get_meters()]))
+
+
+async def run(arguments) -> list:
+    server = FakeKraken(
+        accounts=arguments.accounts,
+        electricity_meters=arguments.electricity,
+        gas_meters=arguments.gas,
+        readings=arguments.readings,
+        latency=arguments.latency / 1000,
+        latency_jitter=arguments.jitter / 1000,
+        error_rate=arguments.error_rate,
+        persisted_queries=arguments.no_persisted_queries == False,
+        compression=arguments.no_compression == False
+    )
+    url = await server.start()
+
+    recorder = Recorder()
+    session = aiohttp.ClientSession(trace_configs=[recorder.trace_config])
+
+    # Its own limiter and breaker, so the shared ones' limits do not skew
+    # the numbers
+    api = eonnext.EonNext(
+        session,
+        api_url=url,
+        max_concurrency=arguments.concurrency,
+        batch_size=arguments.batch_size,
+        rate_limiter=transport.TokenBucket(1000000, 1000000),
+        circuit_breaker=transport.CircuitBreaker(1000000, 0),
+        json_backend=arguments.json_backend
+    )
+    api.transport.backoff_base = 0.01
+
+    trace_memory = arguments.no_memory == False
+    results = []
+    try:
+        results.append(await measure("login", server, recorder, api, api.login_with_username_and_password("bench@example.com", "password", False), trace_memory))
+        results.append(await measure("discovery", server, recorder, api, api.refresh_accounts(), trace_memory))
+        results.append(await measure("refresh", server, recorder, api, api.update_meters(), trace_memory))
+        results.append(await measure("history", server, recorder, api, sync_history(api, arguments.page_size), trace_memory))
+    finally:
+        await api.close()
+        await session.close()
+        await server.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Eon Next client against a local fake Kraken API")
+    parser.add_argument("--accounts", type=int, default=2)
+    parser.add_argument("--electricity", type=int, default=2, help="electricity meters per account")
+    parser.add_argument("--gas", type=int, default=1, help="gas meters per account")
+    parser.add_argument("--readings", type=int, default=365, help="readings per meter")
+    parser.add_argument("--latency", type=float, default=20, help="server latency in ms")
+    parser.add_argument("--jitter", type=float, default=10, help="server latency jitter in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 503")
+    parser.add_argument("--page-size", type=int, default=eonnext.DEFAULT_HISTORY_PAGE_SIZE)
+    parser.add_argument("--batch-size", type=int, default=eonnext.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=eonnext.DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--no-persisted-queries", action="store_true", help="make the server refuse persisted queries")
+    parser.add_argument("--no-compression", action="store_true", help="make the server send uncompressed responses")
+    parser.add_argument("--json-backend", choices=sorted(transport.JSON_BACKENDS), default=transport.DEFAULT_JSON_BACKEND, help="parser of request and response bodies")
+    parser.add_argument("--no-memory", action="store_true", help="do not trace peak memory, for undistorted timings")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    arguments = parser.parse_args()
+
+    results = asyncio.run(run(arguments))
+
+    if arguments.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("%-10s %9s %10s %9s %9s %10s %9s %9s %10s" % ("scenario", "requests", "wall ms", "p50 ms", "p99 ms", "decode ms", "up KiB", "down KiB", "peak KiB"))
+    for result in results:
+        print("%-10s %9d %10.1f %9.1f %9.1f %10.1f %9.1f %9.1f %10.1f" % (
+            result['scenario'], result['requests'], result['wall_ms'], result['p50_ms'], result['p99_ms'], result['decode_ms'], result['sent_kib'], result['received_kib'], result['peak_kib']
+        ))
+
+
+if __name__ == "__main__":
+    main()
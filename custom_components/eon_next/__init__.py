@@ -1,31 +1,161 @@
 #!/usr/bin/env python3
 
+import datetime
 import logging
-from .eonnext import EonNext
+
+import voluptuous as vol
+
+from homeassistant.exceptions import ConfigEntryNotReady, HomeAssistantError
+from homeassistant.helpers.storage import Store
+import homeassistant.helpers.config_validation as cv
+
+from .const import DOMAIN, CONF_CALORIFIC_VALUE, CONF_EMAIL, CONF_PASSWORD
+from .coordinator import EonNextCoordinator
+from .eonnext import EonNextApiError
+from .export import EXPORT_FORMATS, FORMAT_CSV, export_readings
+from .hub import async_get_hub
+from .tariffs import DEFAULT_CALORIFIC_VALUE
 
 _LOGGER = logging.getLogger(__name__)
 
-DOMAIN = "eon_next"
-CONF_EMAIL = "email"
-CONF_PASSWORD = "password"
+STORAGE_VERSION = 1
+TOPOLOGY_TTL = datetime.timedelta(hours=24)
+
+SERVICE_REFRESH_READINGS = "refresh_readings"
+SERVICE_EXPORT_READINGS = "export_readings"
+
+EXPORT_READINGS_SCHEMA = vol.Schema({
+    vol.Required("path"): cv.string,
+    vol.Optional("format", default=FORMAT_CSV): vol.In(EXPORT_FORMATS),
+    vol.Optional("serials"): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional("start"): cv.date,
+    vol.Optional("end"): cv.date,
+    vol.Optional("resume", default=True): cv.boolean
+})
 
 
 async def async_setup_entry(hass, entry):
     """Set up platform from a ConfigEntry."""
-    hass.data.setdefault(DOMAIN, {})
+    hub = async_get_hub(hass)
+
+    api = hub.create_client(calorific_value=entry.options.get(CONF_CALORIFIC_VALUE, DEFAULT_CALORIFIC_VALUE))
+    api.set_credentials(entry.data[CONF_EMAIL], entry.data[CONF_PASSWORD])
+
+    store = Store(hass, STORAGE_VERSION, DOMAIN + "." + entry.entry_id)
+    cache = await store.async_load() or {}
+    discovered = cache.get("discovered", 0)
+
+    if api.restore_state(cache.get("client", {})) == False:
+        try:
+            success = await api.login_with_username_and_password(entry.data[CONF_EMAIL], entry.data[CONF_PASSWORD])
+        except EonNextApiError as err:
+            await api.close()
+            raise ConfigEntryNotReady(str(err)) from err
+
+        if success == False:
+            await api.close()
+            return False
+        discovered = datetime.datetime.now().timestamp()
+
+    hub.claim_accounts(entry.entry_id, api)
+
+    coordinator = EonNextCoordinator(hass, api, store, discovered, hub.reading_store)
+    coordinator.async_save_cache()
+    entry.async_on_unload(coordinator.async_add_listener(coordinator.async_save_cache))
+    entry.async_on_unload(entry.add_update_listener(_async_options_updated))
+
+    hub.register(entry.entry_id, coordinator)
+
+    # Entities are created from the meter topology alone, so the first fetch
+    # of readings does not hold up startup
+    hass.async_create_task(coordinator.async_refresh())
+
+    if datetime.datetime.now().timestamp() - discovered > TOPOLOGY_TTL.total_seconds():
+        hass.async_create_task(_async_revalidate_topology(hass, entry, coordinator))
+
+    if hass.services.has_service(DOMAIN, SERVICE_REFRESH_READINGS) == False:
+        hass.services.async_register(DOMAIN, SERVICE_REFRESH_READINGS, _async_handle_refresh_readings)
+        hass.services.async_register(DOMAIN, SERVICE_EXPORT_READINGS, _async_handle_export_readings, schema=EXPORT_READINGS_SCHEMA)
+
+    hass.async_create_task(
+        hass.config_entries.async_forward_entry_setup(entry, "sensor")
+    )
 
-    api = EonNext()
-    success = await api.login_with_username_and_password(entry.data[CONF_EMAIL], entry.data[CONF_PASSWORD])
+    return True
 
-    if success == True:
 
-        hass.data[DOMAIN][entry.entry_id] = api
+async def async_unload_entry(hass, entry):
+    """Unload a ConfigEntry."""
+    unloaded = await hass.config_entries.async_forward_entry_unload(entry, "sensor")
 
-        hass.async_create_task(
-            hass.config_entries.async_forward_entry_setup(entry, "sensor")
+    if unloaded == True:
+        hub = hass.data[DOMAIN]
+        coordinator = hub.coordinators[entry.entry_id]
+
+        await coordinator.async_shutdown()
+        await coordinator.store.async_save(coordinator.cache_data())
+        await coordinator.api.close()
+        await hub.async_unregister(entry.entry_id)
+
+        if len(hub.coordinators) == 0:
+            hass.services.async_remove(DOMAIN, SERVICE_REFRESH_READINGS)
+            hass.services.async_remove(DOMAIN, SERVICE_EXPORT_READINGS)
+            hass.data.pop(DOMAIN)
+
+    return unloaded
+
+
+async def _async_options_updated(hass, entry):
+    """Reload so that changed options take effect."""
+    await hass.config_entries.async_reload(entry.entry_id)
+
+
+async def _async_handle_refresh_readings(call):
+    """Fetch new readings for every meter straight away."""
+    await call.hass.data[DOMAIN].async_refresh_meters()
+
+
+async def _async_handle_export_readings(call):
+    """Stream the reading history of some or all meters to a file."""
+    path = call.hass.config.path(call.data["path"])
+    if call.hass.config.is_allowed_path(path) == False:
+        raise HomeAssistantError("Exporting to " + path + " is not allowed, add its folder to allowlist_external_dirs")
+
+    meters = call.hass.data[DOMAIN].meters()
+    if "serials" in call.data:
+        meters = [meter for meter in meters if meter.get_serial() in call.data["serials"]]
+        if len(meters) == 0:
+            raise HomeAssistantError("No Eon Next meters match the serial numbers given")
+
+    try:
+        rows = await export_readings(
+            meters,
+            path,
+            call.data["format"],
+            call.data.get("start"),
+            call.data.get("end"),
+            resume=call.data["resume"]
         )
+    except Exception as err:
+        raise HomeAssistantError("Unable to export Eon Next readings: " + str(err)) from err
+
+    _LOGGER.info("Exported %s Eon Next readings to %s", rows, path)
+
+
+async def _async_revalidate_topology(hass, entry, coordinator):
+    """Rediscover accounts and meters in the background after a warm start."""
+    before = coordinator.api.topology()
+    try:
+        await coordinator.api.refresh_accounts()
+    except Exception as err:
+        _LOGGER.warning("Unable to revalidate Eon Next accounts: %s", err)
+        return
+
+    hass.data[DOMAIN].claim_accounts(entry.entry_id, coordinator.api)
+
+    coordinator.discovered = datetime.datetime.now().timestamp()
+    coordinator.async_save_cache()
 
-        return True
-    
-    else:
-        return False
\ No newline at end of file
+    if coordinator.api.topology() != before:
+        _LOGGER.info("Eon Next meters have changed, reloading")
+        await hass.config_entries.async_reload(entry.entry_id)
@@ -8,11 +8,15 @@ from typing import Any
 import voluptuous as vol
 
 from homeassistant import config_entries
+from homeassistant.core import callback
 import homeassistant.helpers.config_validation as cv
 
-from .eonnext import EonNext
+from .eonnext import EonNextApiError
+from .hub import async_get_hub
+from .tariffs import DEFAULT_CALORIFIC_VALUE
 
 from . import DOMAIN, CONF_EMAIL, CONF_PASSWORD
+from .const import CONF_CALORIFIC_VALUE
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -26,20 +30,34 @@ class EonNextConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         pass
 
 
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry):
+        return EonNextOptionsFlow(config_entry)
+
+
     async def async_step_user(self, user_input=None):
         """Invoked when a user initiates a flow via the user interface."""
 
         errors = {}
         if user_input is not None:
 
-            en = EonNext()
-            success = await en.login_with_username_and_password(
-                user_input[CONF_EMAIL],
-                user_input[CONF_PASSWORD],
-                False
-            )
+            en = async_get_hub(self.hass).create_client()
+            try:
+                success = await en.login_with_username_and_password(
+                    user_input[CONF_EMAIL],
+                    user_input[CONF_PASSWORD],
+                    False
+                )
+            except EonNextApiError:
+                success = None
+            finally:
+                await en.close()
+
+            if success == None:
+                errors["base"] = "cannot_connect"
 
-            if success == True:
+            elif success == True:
 
                 return self.async_create_entry(title="Eon Next", data={
                     CONF_EMAIL: user_input[CONF_EMAIL],
@@ -53,3 +71,25 @@ class EonNextConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             vol.Required(CONF_EMAIL): cv.string,
             vol.Required(CONF_PASSWORD): cv.string
         }), errors=errors)
+
+
+
+class EonNextOptionsFlow(config_entries.OptionsFlow):
+    """Handle eon next options."""
+
+    def __init__(self, config_entry) -> None:
+        self._entry = config_entry
+
+
+    async def async_step_init(self, user_input=None):
+        """Calorific value used to convert gas readings to kWh."""
+
+        if user_input is not None:
+            return self.async_create_entry(title="", data=user_input)
+
+        return self.async_show_form(step_id="init", data_schema=vol.Schema({
+            vol.Required(
+                CONF_CALORIFIC_VALUE,
+                default=self._entry.options.get(CONF_CALORIFIC_VALUE, DEFAULT_CALORIFIC_VALUE)
+            ): vol.All(vol.Coerce(float), vol.Range(min=30, max=50))
+        }))
@@ -0,0 +1,9 @@
+#!/usr/bin/env python3
+
+DOMAIN = "eon_next"
+CONF_EMAIL = "email"
+CONF_PASSWORD = "password"
+CONF_CALORIFIC_VALUE = "calorific_value"
+
+# Tariffs are priced in pence, costs are reported in pounds
+CURRENCY = "GBP"
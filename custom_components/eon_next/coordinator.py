@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+import asyncio
+import datetime
+import logging
+import time
+
+from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
+
+from .const import DOMAIN
+from .eonnext import EonNextAuthenticationError, EonNextGraphQLError
+from .statistics import async_import_cost_statistics, async_import_meter_statistics
+
+_LOGGER = logging.getLogger(__name__)
+
+# Each meter's scheduler decides whether it is actually fetched, so the hub
+# only needs to refresh often enough to honour those schedules
+UPDATE_INTERVAL = datetime.timedelta(minutes=15)
+STORAGE_SAVE_DELAY = 60
+HISTORY_PAGE_SIZE = 100
+CONSUMPTION_INTERVAL = datetime.timedelta(minutes=30)
+CONSUMPTION_RETENTION = datetime.timedelta(days=62)
+TARIFF_RETRY_INTERVAL = datetime.timedelta(hours=1)
+
+# Meters whose history or consumption is synced at once. Separate from the
+# client's own limit, so a long backfill never holds up routine refreshes.
+SYNC_CONCURRENCY = 2
+
+
+class EonNextCoordinator(DataUpdateCoordinator):
+    """Refresh every meter of a config entry once per cycle.
+
+    It has no timer of its own, the hub refreshes every entry together."""
+
+    def __init__(self, hass, api, store, discovered: float, reading_store):
+        super().__init__(hass, _LOGGER, name=DOMAIN, update_interval=None)
+        self.api = api
+        self.store = store
+        self.discovered = discovered
+        self.reading_store = reading_store
+        self._history_task = None
+        self._statistics_checked = set()
+        self.last_refresh_duration = None
+        self._consumption_checked = {}
+        self._consumption_unsupported = set()
+        self._tariffs_checked = None
+        self._costed_rate_tables = {}
+        self._sync_semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+        # Total cost in pounds of each meter's stored history
+        self.costs = {}
+    
+
+    async def async_refresh_meters(self):
+        """Fetch every meter now, regardless of its schedule."""
+        for meter in self.meters():
+            meter.request_refresh()
+        await self.async_request_refresh()
+    
+
+    def cache_data(self) -> dict:
+        return {
+            "discovered": self.discovered,
+            "client": self.api.export_state()
+        }
+    
+
+    def async_save_cache(self):
+        """Persist the refresh token and meter topology for the next start."""
+        self.store.async_delay_save(self.cache_data, STORAGE_SAVE_DELAY)
+    
+
+    async def _async_gather(self, coroutines: list) -> list:
+        # Runs at most SYNC_CONCURRENCY at a time, returning exceptions in
+        # place of results
+        async def limited(coroutine):
+            async with self._sync_semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[limited(coroutine) for coroutine in coroutines], return_exceptions=True)
+    
+
+    def meters(self) -> list:
+        return self.api.get_meters()
+    
+
+    async def _async_update_data(self):
+        """Fetch new readings for every meter that is due an update."""
+        meters = self.meters()
+
+        # While the API is unhealthy the last known values are kept rather
+        # than making every entity unavailable
+        if self.api.is_available() == False:
+            _LOGGER.debug("Eon Next API is unavailable, keeping last known readings")
+            return meters
+
+        started = time.monotonic()
+        errors = await self.api.update_meters(meters)
+        self.last_refresh_duration = time.monotonic() - started
+
+        if len(meters) > 0 and len(errors) == len(meters):
+            if self.api.is_available() == False:
+                return meters
+            raise UpdateFailed("Unable to update any meters: " + str(errors[0]))
+
+        await self._async_update_consumption(meters)
+        await self._async_update_tariffs()
+
+        # A first sync backfills the whole history, so it runs in the
+        # background rather than holding up the refresh
+        if self._history_task == None or self._history_task.done():
+            self._history_task = self.hass.async_create_task(self._async_sync_history(meters))
+
+        return meters
+    
+
+    async def _async_update_consumption(self, meters: list):
+        """Fetch new half-hourly consumption for smart meters which support it."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        due = []
+        for meter in meters:
+            if meter.supply_point_id == None or meter.meter_id in self._consumption_unsupported:
+                continue
+            if now - self._consumption_checked.get(meter.meter_id, datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)) < CONSUMPTION_INTERVAL:
+                continue
+            due.append(meter)
+
+        results = await self._async_gather([meter.update_consumption() for meter in due])
+        for meter, result in zip(due, results):
+            if isinstance(result, EonNextGraphQLError) and isinstance(result, EonNextAuthenticationError) == False:
+                _LOGGER.info("Half-hourly consumption is not available for meter %s: %s", meter.get_serial(), result)
+                self._consumption_unsupported.add(meter.meter_id)
+            elif isinstance(result, Exception):
+                _LOGGER.warning("Unable to update consumption for meter %s: %s", meter.get_serial(), result)
+            else:
+                self._consumption_checked[meter.meter_id] = now
+                meter.consumption.trim(now - CONSUMPTION_RETENTION)
+    
+
+    async def _async_update_tariffs(self):
+        """Fetch tariff agreements once the cached ones have expired."""
+        # The client only refetches expired agreements, so this only holds
+        # back retries after a failure
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if self._tariffs_checked != None and now - self._tariffs_checked < TARIFF_RETRY_INTERVAL:
+            return
+
+        errors = await self.api.update_tariffs()
+        self._tariffs_checked = now if len(errors) > 0 else None
+    
+
+    async def _async_sync_history(self, meters: list):
+        """Copy new readings into the reading store and recorder statistics."""
+        costs = dict(self.costs)
+
+        results = await self._async_gather([self._async_sync_meter_history(meter) for meter in meters])
+        for meter, result in zip(meters, results):
+            if isinstance(result, Exception):
+                _LOGGER.warning("Unable to sync reading history for meter %s: %s", meter.get_serial(), result)
+
+        if self.costs != costs:
+            self.async_update_listeners()
+    
+
+    async def _async_sync_meter_history(self, meter):
+        changed = await self._async_sync_meter_readings(meter)
+
+        # Statistics are checked once after startup even without new readings,
+        # to pick up anything that was stored but never imported
+        if "recorder" in self.hass.config.components:
+            if changed == True or meter.meter_id not in self._statistics_checked:
+                await async_import_meter_statistics(self.hass, self.reading_store, meter)
+                self._statistics_checked.add(meter.meter_id)
+
+        # Costs are worked out again for the whole history whenever there
+        # are new readings or the tariffs have been refetched
+        if meter.rate_table != None and (changed == True or self._costed_rate_tables.get(meter.meter_id) != meter.rate_table):
+            await self._async_update_meter_costs(meter)
+            self._costed_rate_tables[meter.meter_id] = meter.rate_table
+    
+
+    async def _async_update_meter_costs(self, meter):
+        deltas = await self.hass.async_add_executor_job(self.reading_store.daily_deltas, meter.meter_id)
+        costs = await self.hass.async_add_executor_job(meter.daily_costs, deltas)
+        if costs == None:
+            return
+
+        priced = [cost for day, kwh, cost in costs if cost != None]
+        if len(priced) > 0:
+            self.costs[meter.meter_id] = round(sum(priced) / 100, 2)
+
+        if "recorder" in self.hass.config.components:
+            await async_import_cost_statistics(self.hass, meter, costs)
+    
+
+    async def _async_sync_meter_readings(self, meter) -> bool:
+        # Readings come newest first, so the newest stored reading says
+        # nothing about whether older pages made it. Progress is kept in the
+        # store instead, and an interrupted sync carries on from its cursor.
+        synced_id, pending_id, cursor = await self.hass.async_add_executor_job(self.reading_store.sync_state, meter.meter_id)
+        meter.synced_reading_id = synced_id
+
+        if pending_id == None:
+            if meter.latest_reading_id == None or meter.latest_reading_id == synced_id:
+                return False
+            cursor = ""
+
+        async for readings, next_cursor in meter.iter_reading_pages(HISTORY_PAGE_SIZE, cursor or ""):
+            if pending_id == None and len(readings) > 0:
+                pending_id = readings[0].reading_id
+
+            new = []
+            for reading in readings:
+                if reading.reading_id == synced_id:
+                    next_cursor = None
+                    break
+                new.append(reading)
+
+            if len(new) > 0:
+                await self.hass.async_add_executor_job(self.reading_store.upsert_readings, meter.meter_id, new)
+
+            if next_cursor == None:
+                break
+            await self.hass.async_add_executor_job(self.reading_store.save_sync_state, meter.meter_id, synced_id, pending_id, next_cursor)
+
+        await self.hass.async_add_executor_job(self.reading_store.save_sync_state, meter.meter_id, pending_id or synced_id)
+        meter.synced_reading_id = pending_id or synced_id
+        return True
+    
+
+    async def async_shutdown(self) -> None:
+        """Stop any history sync which is still running."""
+        await super().async_shutdown()
+        if self._history_task != None:
+            self._history_task.cancel()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import datetime
+
+from . import queries
+from .readings import parse_readings
+from .tariffs import Agreement
+from .transport import EonNextDecodeError
+
+# Decoders by operation name. Each takes the response's data, and any extra
+# arguments of the call, and indexes straight into the shape its query asks
+# for; a missing or mistyped field fails the whole decode at once.
+DECODERS = {}
+
+# Raised by indexing into a response which does not have the expected shape
+SHAPE_ERRORS = (AttributeError, IndexError, KeyError, TypeError, ValueError)
+
+
+class ReadingsPage:
+    """A page of MeterReading records, newest first, and the cursor of the
+    next page, which is None with the last page."""
+
+    __slots__ = ("readings", "cursor")
+
+    def __init__(self, readings: list, cursor: str):
+        self.readings = readings
+        self.cursor = cursor
+
+
+def decoder(*operations):
+    def register(function):
+        for operation in operations:
+            DECODERS[operation] = function
+        return function
+    return register
+
+
+def decode(operation: str, result: dict, *args):
+    """Turn the response to an operation into models with its decoder,
+    raising EonNextDecodeError if it is not of the expected shape."""
+    try:
+        return DECODERS[operation](result['data'], *args)
+    except SHAPE_ERRORS as err:
+        raise EonNextDecodeError(operation, "unexpected response, " + type(err).__name__ + " " + str(err)) from err
+
+
+def _next_cursor(connection: dict) -> str:
+    page_info = connection.get("pageInfo") or {}
+    if page_info.get("hasNextPage") != True:
+        return None
+    return page_info.get("endCursor")
+
+
+@decoder(queries.LOGIN.operation, queries.REFRESH_TOKEN.operation)
+def decode_token(data: dict) -> dict:
+    token = data['obtainKrakenToken']
+    if isinstance(token['token'], str) == False or isinstance(token['refreshToken'], str) == False:
+        raise TypeError("token is not a string")
+    int(token['payload']['iat'])
+    int(token['payload']['exp'])
+    int(token['refreshExpiresIn'])
+    return token
+
+
+@decoder(queries.ACCOUNT_NUMBERS.operation)
+def decode_account_numbers(data: dict) -> list:
+    return [account['number'] for account in data['viewer']['accounts']]
+
+
+@decoder(queries.ACCOUNT_METERS.operation)
+def decode_account_meters(data: dict) -> list:
+    # (property id, electricity meters, gas meters) for each property, with
+    # each meter as (meter id, serial, MPAN or MPRN, register names)
+    properties = []
+    for property in data['properties']:
+        electricity_meters = [
+            (meter['id'], meter['serialNumber'], point.get("mpan"), _register_names(meter))
+            for point in property['electricityMeterPoints'] for meter in point['meters']
+        ]
+        gas_meters = [
+            (meter['id'], meter['serialNumber'], point.get("mprn"), _register_names(meter))
+            for point in property['gasMeterPoints'] for meter in point['meters']
+        ]
+        properties.append((property.get("id"), electricity_meters, gas_meters))
+    return properties
+
+
+def _register_names(meter: dict) -> list:
+    return [register['name'] for register in meter.get("registers") or [] if register.get("name") != None]
+
+
+@decoder(queries.ELECTRICITY_READINGS.operation, queries.GAS_READINGS.operation)
+def decode_readings_page(data: dict) -> ReadingsPage:
+    connection = data['readings']
+    return ReadingsPage(parse_readings(connection['edges']), _next_cursor(connection))
+
+
+@decoder(queries.BATCH_READINGS_OPERATION)
+def decode_batch_readings(data: dict, count: int) -> list:
+    # The readings of each meter of the batch in order, None for any the
+    # response has no answer for
+    batch = []
+    for index in range(count):
+        connection = data.get("m" + str(index))
+        if connection == None or connection.get("edges") == None:
+            batch.append(None)
+        else:
+            batch.append(parse_readings(connection['edges']))
+    return batch
+
+
+@decoder(queries.CONSUMPTION.operation)
+def decode_consumption_page(data: dict, property_id: str = None) -> tuple:
+    # ([(interval start, value, unit)], cursor of the next page) from the
+    # property's measurements, or the first property with any
+    for property in data['account']['properties']:
+        if property_id != None and property.get("id") != property_id:
+            continue
+
+        connection = property.get("measurements") or {}
+        if connection.get("edges") == None:
+            continue
+
+        intervals = []
+        for edge in connection['edges']:
+            node = edge['node']
+            if node.get("startAt") != None and node.get("value") != None:
+                intervals.append((datetime.datetime.fromisoformat(node['startAt']), float(node['value']), node.get("unit")))
+        return intervals, _next_cursor(connection)
+
+    return [], None
+
+
+@decoder(queries.AGREEMENTS.operation)
+def decode_agreements(data: dict) -> dict:
+    # Agreements by supply point (MPAN or MPRN)
+    account = data['account']
+    agreements = {}
+    for field, supply_point_field in (("electricityAgreements", "mpan"), ("gasAgreements", "mprn")):
+        for agreement in account.get(field) or []:
+            supply_point_id = (agreement.get("meterPoint") or {}).get(supply_point_field)
+            agreements.setdefault(supply_point_id, []).append(Agreement.from_api(supply_point_id, agreement))
+    return agreements
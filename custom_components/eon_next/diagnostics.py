@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+from homeassistant.components.diagnostics import async_redact_data
+
+from .const import DOMAIN, CONF_EMAIL, CONF_PASSWORD
+
+TO_REDACT = {CONF_EMAIL, CONF_PASSWORD, "refresh_token"}
+
+
+async def async_get_config_entry_diagnostics(hass, entry) -> dict:
+    """Return diagnostics for a config entry."""
+    coordinator = hass.data[DOMAIN].coordinators[entry.entry_id]
+    api = coordinator.api
+
+    return {
+        "entry": async_redact_data(dict(entry.data), TO_REDACT),
+        "api": {
+            "available": api.is_available(),
+            "metrics": api.metrics.as_dict()
+        },
+        "coordinator": {
+            "last_update_success": coordinator.last_update_success,
+            "last_refresh_duration": coordinator.last_refresh_duration,
+            "update_interval": str(coordinator.update_interval)
+        },
+        "meters": [
+            {
+                "type": meter.get_type(),
+                "latest_reading_date": None if meter.latest_reading_date == None else meter.latest_reading_date.isoformat(),
+                "last_updated": None if meter.last_updated == None else meter.last_updated.isoformat(),
+                "next_check": None if meter.scheduler.next_check == None else meter.scheduler.next_check.isoformat()
+            }
+            for meter in coordinator.meters()
+        ]
+    }
@@ -1,29 +1,153 @@
 #!/usr/bin/env python3
 
 import aiohttp
+import asyncio
 import datetime
+import logging
+import time
+
+from . import decoders, export, queries, tariffs
+from .metrics import ApiMetrics
+from .queries import PersistedQuery
+from .readings import bound
+from .scheduler import ReadingScheduler
+from .tariffs import DEFAULT_CALORIFIC_VALUE, DEFAULT_TARIFF_TTL, CalorificValues, RateTable
+from .timeseries import IntervalSeries
+from .transport import (
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_REQUEST_TIMEOUT,
+    EonNextApiError,
+    EonNextAuthenticationError,
+    EonNextDecodeError,
+    EonNextGraphQLError,
+    EonNextTransportError,
+    EonNextUnavailable,
+    GraphQLTransport,
+    graphql_error
+)
+
+_LOGGER = logging.getLogger(__name__)
 
 METER_TYPE_GAS = "gas"
 METER_TYPE_ELECTRIC = "electricity"
 METER_TYPE_UNKNOWN = "unknown"
 
+API_URL = "https://api.eonnext-kraken.energy/v1/graphql/"
+
+DEFAULT_CONNECTION_LIMIT = 10
+DEFAULT_DNS_CACHE_TTL = 300
+DEFAULT_KEEPALIVE_TIMEOUT = 60
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_TOKEN_REFRESH_MARGIN = 300
+# A failed background token refresh is retried after this many seconds,
+# doubling with each failure up to the maximum
+AUTH_RETRY_BASE = 15
+AUTH_RETRY_MAX = 600
+DEFAULT_HISTORY_PAGE_SIZE = 100
+DEFAULT_CONSUMPTION_PAGE_SIZE = 96
+DEFAULT_CONSUMPTION_BACKFILL = datetime.timedelta(days=2)
+
+
 
 class EonNext:
 
-    def __init__(self):
+    def __init__(self, session: aiohttp.ClientSession = None, connection_limit: int = DEFAULT_CONNECTION_LIMIT, dns_cache_ttl: int = DEFAULT_DNS_CACHE_TTL, keepalive_timeout: int = DEFAULT_KEEPALIVE_TIMEOUT, max_concurrency: int = DEFAULT_MAX_CONCURRENCY, batch_size: int = DEFAULT_BATCH_SIZE, token_refresh_margin: int = DEFAULT_TOKEN_REFRESH_MARGIN, request_timeout: float = DEFAULT_REQUEST_TIMEOUT, max_retries: int = DEFAULT_MAX_RETRIES, rate_limiter = None, circuit_breaker = None, api_url: str = API_URL, calorific_value: float = DEFAULT_CALORIFIC_VALUE, tariff_ttl: datetime.timedelta = DEFAULT_TARIFF_TTL, json_backend: str = None):
         self.username = ""
         self.password = ""
+
+        # An injected session (e.g. Home Assistant's shared one) belongs to
+        # the caller and is never closed here. Otherwise a pooled session is
+        # created on first use and kept until close().
+        self.__session = session
+        self.__owns_session = session == None
+        self.__connection_limit = connection_limit
+        self.__dns_cache_ttl = dns_cache_ttl
+        self.__keepalive_timeout = keepalive_timeout
+
+        # Timeouts, retries, rate limiting and the circuit breaker. Unless
+        # given their own, all clients share one rate limiter and breaker.
+        # Responses are parsed with orjson when it is installed.
+        self.metrics = ApiMetrics()
+        self.transport = GraphQLTransport(
+            api_url,
+            request_timeout=request_timeout,
+            max_retries=max_retries,
+            rate_limiter=rate_limiter,
+            circuit_breaker=circuit_breaker,
+            metrics=self.metrics,
+            json_backend=json_backend
+        )
+
+        # Caps how many discovery and reading requests run at the same time
+        self.__semaphore = asyncio.Semaphore(max_concurrency)
+
+        # Readings for up to batch_size meters are fetched in one request.
+        # Cleared if the server rejects a batched query, after which every
+        # meter is fetched on its own.
+        self.__batch_size = batch_size
+        self.__batch_supported = True
+
+        # The auth token is renewed in the background this many seconds
+        # before it expires, so requests never wait on a refresh. Refreshes
+        # are serialised by the lock and shared by everyone waiting on it.
+        self.__token_refresh_margin = token_refresh_margin
+        self.__auth_lock = asyncio.Lock()
+        self.__auth_refresh_timer = None
+        self.__auth_refresh_task = None
+        self.__auth_refresh_failures = 0
+
+        # Tariff agreements are refetched once they are older than tariff_ttl.
+        # Gas is converted to kWh with calorific_value unless values by date
+        # are set on calorific_values.
+        self.tariff_ttl = tariff_ttl
+        self.calorific_values = CalorificValues(calorific_value)
+
         self.__reset_authentation()
         self.__reset_accounts()
     
 
-    def _json_contains_key_chain(self, data: dict, key_chain: list) -> bool:
-        for key in key_chain:
-            if key in data:
-                data = data[key]
-            else:
-                return False
-        return True
+    async def __aenter__(self):
+        return self
+    
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+    
+
+    def __get_session(self) -> aiohttp.ClientSession:
+        if self.__owns_session == True and (self.__session == None or self.__session.closed == True):
+            connector = aiohttp.TCPConnector(
+                limit=self.__connection_limit,
+                limit_per_host=self.__connection_limit,
+                use_dns_cache=True,
+                ttl_dns_cache=self.__dns_cache_ttl,
+                keepalive_timeout=self.__keepalive_timeout
+            )
+            self.__session = aiohttp.ClientSession(connector=connector)
+        return self.__session
+    
+
+    async def close(self):
+        self.__cancel_auth_refresh()
+        if self.__auth_refresh_task != None:
+            self.__auth_refresh_task.cancel()
+            self.__auth_refresh_task = None
+
+        if self.__owns_session == True and self.__session != None:
+            await self.__session.close()
+            self.__session = None
+    
+
+    async def _gather(self, coroutines: list) -> list:
+        # Runs at most max_concurrency at a time. Exceptions are returned in
+        # place of results rather than raised, so one failure does not cancel
+        # the rest.
+        async def limited(coroutine):
+            async with self.__semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[limited(coroutine) for coroutine in coroutines], return_exceptions=True)
     
 
     def __current_timestamp(self) -> int:
@@ -32,6 +156,7 @@ class EonNext:
 
 
     def __reset_authentation(self):
+        self.__cancel_auth_refresh()
         self.auth = {
             "issued": None,
             "token": {
@@ -56,13 +181,59 @@ class EonNext:
                 "expires": kraken_token['refreshExpiresIn']
             }
         }
+        self.__schedule_auth_refresh()
+    
+
+    def __schedule_auth_refresh(self):
+        self.__cancel_auth_refresh()
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+
+        delay = self.auth['token']['expires'] - self.__token_refresh_margin - self.__current_timestamp()
+        self.__auth_refresh_timer = loop.call_later(max(delay, 0), self.__start_background_auth_refresh)
+    
+
+    def __cancel_auth_refresh(self):
+        if self.__auth_refresh_timer != None:
+            self.__auth_refresh_timer.cancel()
+            self.__auth_refresh_timer = None
+    
+
+    def __start_background_auth_refresh(self):
+        self.__auth_refresh_timer = None
+        self.__auth_refresh_task = asyncio.ensure_future(self.__background_auth_refresh())
     
 
-    def __auth_token_is_valid(self) -> bool:
+    async def __background_auth_refresh(self):
+        try:
+            await self.__refresh_authentication(self.__token_refresh_margin)
+            error = "no token was obtained"
+        except Exception as err:
+            error = err
+
+        # A new token schedules its own refresh. Otherwise this is tried
+        # again, so the token is not left to expire and be refreshed in the
+        # middle of a request.
+        if self.__auth_token_is_valid(self.__token_refresh_margin) == True:
+            self.__auth_refresh_failures = 0
+            return
+
+        delay = min(AUTH_RETRY_BASE * (2 ** self.__auth_refresh_failures), AUTH_RETRY_MAX)
+        self.__auth_refresh_failures = self.__auth_refresh_failures + 1
+        _LOGGER.warning("Background token refresh failed, retrying in %s seconds: %s", delay, error)
+
+        self.__cancel_auth_refresh()
+        self.__auth_refresh_timer = asyncio.get_running_loop().call_later(delay, self.__start_background_auth_refresh)
+    
+
+    def __auth_token_is_valid(self, margin: int = 0) -> bool:
         if self.auth['token']['token'] == None:
             return False
         
-        if self.auth['token']['expires'] <= self.__current_timestamp():
+        if self.auth['token']['expires'] - margin <= self.__current_timestamp():
             return False
         
         return True
@@ -72,58 +243,104 @@ class EonNext:
         if self.auth['refresh']['token'] == None:
             return False
         
-        if self.auth['refresh']['expires'] <= self.__current_timestamp():
+        # A refresh token supplied from elsewhere may come without its expiry
+        if self.auth['refresh']['expires'] != None and self.auth['refresh']['expires'] <= self.__current_timestamp():
             return False
         
         return True
     
 
+    async def __refresh_authentication(self, margin: int = 0):
+        async with self.__auth_lock:
+            # Whoever held the lock before us may already have refreshed
+            if self.__auth_token_is_valid(margin) == True:
+                return
+
+            if self.__refresh_token_is_valid() == True:
+                success = await self.__login_with_refresh_token()
+                self.metrics.record_token_refresh("refresh_token", success)
+                if success == True:
+                    return
+
+            if self.username != "" and self.password != "":
+                success = await self.login_with_username_and_password(self.username, self.password, False)
+                self.metrics.record_token_refresh("password", success)
+    
+
     async def __auth_token(self) -> str:
         if self.__auth_token_is_valid() == False:
-            if self.__refresh_token_is_valid() == True:
-                await self.__login_with_refresh_token()
-            else:
-                await self.login_with_username_and_password()
+            await self.__refresh_authentication()
         
+        # A refresh that could not reach the API has already raised, so only
+        # rejected or missing credentials get this far
         if self.__auth_token_is_valid() == False:
-            raise Exception("Unable to authenticate")
+            raise EonNextAuthenticationError("Unable to authenticate")
 
         return self.auth['token']['token']
     
 
-    async def _graphql_post(self, operation: str, query: str, variables: dict={}, authenticated: bool = True) -> dict:
+    async def _graphql_post(self, query: PersistedQuery, variables: dict = None, authenticated: bool = True) -> dict:
+        operation = query.operation
         use_headers = {}
 
+        if variables == None:
+            variables = {}
+
         if authenticated == True:
             use_headers['authorization'] = "JWT " + await self.__auth_token()
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.eonnext-kraken.energy/v1/graphql/",
-                json={"operationName": operation, "variables": variables, "query": query},
-                headers=use_headers
-            ) as response:
-                return await response.json()
+        result = await self.transport.post_query(self.__get_session(), query, variables, use_headers)
+
+        # Partial data alongside errors is left for the caller to pick through
+        if isinstance(result, dict) and len(result.get("errors") or []) > 0:
+            error = graphql_error(operation, result['errors'])
+            self.metrics.record_error(operation, str(error))
+            if result.get("data") == None:
+                raise error
+
+        return result
+    
+
+    async def _graphql_query(self, query: PersistedQuery, variables: dict = None, authenticated: bool = True, decoder_args: tuple = ()):
+        # Posts the query and turns the response into models with the
+        # decoder of its operation, which is also passed decoder_args,
+        # timing the decode
+        result = await self._graphql_post(query, variables, authenticated)
+
+        started = time.perf_counter()
+        try:
+            return decoders.decode(query.operation, result, *decoder_args)
+        finally:
+            self.metrics.record_decode(query.operation, time.perf_counter() - started)
+    
+
+    def is_available(self) -> bool:
+        # False while the circuit breaker is refusing requests
+        return self.transport.circuit_breaker.is_open() == False
     
 
     async def login_with_username_and_password(self, username: str, password: str, initialise: bool = True) -> bool:
         self.username = username
         self.password = password
         
-        result = await self._graphql_post(
-            "loginEmailAuthentication",
-            "mutation loginEmailAuthentication($input: ObtainJSONWebTokenInput!) {obtainKrakenToken(input: $input) {    payload    refreshExpiresIn    refreshToken    token    __typename}}",
-            {
-                "input": {
-                    "email": self.username,
-                    "password": self.password
-                }
-            },
-            False
-        )
-
-        if self._json_contains_key_chain(result, ["data", "obtainKrakenToken", "token"]) == True:
-            self.__store_authentication(result['data']['obtainKrakenToken'])
+        try:
+            kraken_token = await self._graphql_query(
+                queries.LOGIN,
+                {
+                    "input": {
+                        "email": self.username,
+                        "password": self.password
+                    }
+                },
+                False
+            )
+        except (EonNextGraphQLError, EonNextDecodeError) as err:
+            # Rejected credentials come back as GraphQL errors
+            _LOGGER.debug("Unable to obtain a token: %s", err)
+            kraken_token = None
+
+        if kraken_token != None:
+            self.__store_authentication(kraken_token)
             if initialise == True:
                 await self.__init_accounts()
             return True
@@ -132,25 +349,35 @@ class EonNext:
             return False
     
 
+    def set_credentials(self, username: str, password: str):
+        # Credentials to fall back on when there is no usable refresh token
+        self.username = username
+        self.password = password
+    
+
     async def login_with_refresh_token(self, token: str) -> bool:
         self.auth['refresh']['token'] = token
         return await self.__login_with_refresh_token(True)
     
 
     async def __login_with_refresh_token(self, initialise: bool = False) -> bool:
-        result = await self._graphql_post(
-            "refreshToken",
-            "mutation refreshToken($input: ObtainJSONWebTokenInput!) {  obtainKrakenToken(input: $input) {    payload    refreshExpiresIn    refreshToken    token    __typename  }}",
-            {
-                "input": {
-                    "refreshToken": self.auth['refresh']['token']
-                }
-            },
-            False
-        )
-
-        if self._json_contains_key_chain(result, ["data", "obtainKrakenToken", "token"]) == True:
-            self.__store_authentication(result['data']['obtainKrakenToken'])
+        try:
+            kraken_token = await self._graphql_query(
+                queries.REFRESH_TOKEN,
+                {
+                    "input": {
+                        "refreshToken": self.auth['refresh']['token']
+                    }
+                },
+                False
+            )
+        except (EonNextGraphQLError, EonNextDecodeError) as err:
+            # Rejected credentials come back as GraphQL errors
+            _LOGGER.debug("Unable to obtain a token: %s", err)
+            kraken_token = None
+
+        if kraken_token != None:
+            self.__store_authentication(kraken_token)
             if initialise == True:
                 await self.__init_accounts()
             return True
@@ -161,32 +388,227 @@ class EonNext:
 
     def __reset_accounts(self):
         self.accounts = []
+        # Accounts set aside because another client handles them. They are
+        # not fetched, but are kept in the exported state so that restoring
+        # it can take them back.
+        self.deferred_accounts = []
     
 
     async def __get_account_numbers(self) -> list:
-        result = await self._graphql_post(
-            "headerGetLoggedInUser",
-            "query headerGetLoggedInUser {\n  viewer {\n    accounts {\n      ... on AccountType {\n        applications(first: 1) {\n          edges {\n            node {\n              isMigrated\n              migrationSource\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        balance\n        id\n        number\n        __typename\n      }\n      __typename\n    }\n    id\n    preferredName\n    __typename\n  }\n}\n"
-        )
-        
-        if self._json_contains_key_chain(result, ["data", "viewer", "accounts"]) == False:
-            raise Exception("Unable to load energy accounts")
+        return await self._graphql_query(queries.ACCOUNT_NUMBERS)
+    
 
-        found = []
-        for account_entry in result['data']['viewer']['accounts']:
-            found.append(account_entry['number'])
+    async def __discover_accounts(self, require_all: bool = False) -> list:
+        # Builds a new list of accounts with their meters, leaving
+        # self.accounts alone. Accounts whose meters fail to load are left
+        # out, unless require_all is set, when the first failure is raised.
+        found = [EnergyAccount(self, account_number) for account_number in await self.__get_account_numbers()]
+        results = await self._gather([account._load_meters() for account in found])
+
+        accounts = []
+        errors = []
+        for account, result in zip(found, results):
+            if isinstance(result, Exception):
+                _LOGGER.warning("Unable to load meters for account %s: %s", account.account_number, result)
+                errors.append(result)
+            else:
+                accounts.append(account)
 
-        return found
+        # The first failure is raised as it is, so that an unreachable API
+        # still reads as a transport error
+        if len(errors) > 0 and (require_all == True or len(accounts) == 0):
+            raise errors[0]
+        return accounts
     
 
     async def __init_accounts(self):
         if len(self.accounts) == 0:
-            for account_number in await self.__get_account_numbers():
+            self.accounts = await self.__discover_accounts()
+    
+
+    def topology(self) -> list:
+        return sorted(item for account in self.accounts for item in account.topology())
+    
+
+    async def refresh_accounts(self) -> bool:
+        # Rediscovers accounts and meters, returning True if they changed.
+        # The current accounts stay in place until every account has loaded,
+        # and any failure leaves them untouched. Accounts whose meters did
+        # not change keep their existing objects, and with them their
+        # readings. Deferred accounts are included again.
+        previous_accounts = self.accounts + self.deferred_accounts
+        previous_topology = sorted(item for account in previous_accounts for item in account.topology())
+
+        accounts = await self.__discover_accounts(True)
+
+        existing = {account.account_number: account for account in previous_accounts}
+        for index, account in enumerate(accounts):
+            previous = existing.get(account.account_number)
+            if previous != None and previous.topology() == account.topology():
+                accounts[index] = previous
+
+        self.accounts = accounts
+        self.deferred_accounts = []
+        return self.topology() != previous_topology
+    
+
+    def export_state(self) -> dict:
+        # Everything needed to start again without logging in or rediscovering
+        # meters, suitable for JSON serialisation
+        return {
+            "refresh_token": self.auth['refresh']['token'],
+            "refresh_expires": self.auth['refresh']['expires'],
+            "accounts": [
+                {
+                    "number": account.account_number,
+                    "meters": [
+                        {
+                            "id": meter.meter_id,
+                            "serial": meter.get_serial(),
+                            "type": meter.get_type(),
+                            "supply_point_id": meter.supply_point_id,
+                            "property_id": meter.property_id,
+                            "registers": meter.registers,
+                            "schedule": meter.scheduler.export_state()
+                        }
+                        for meter in account.meters
+                    ]
+                }
+                for account in self.accounts + self.deferred_accounts
+            ]
+        }
+    
+
+    def restore_state(self, state: dict) -> bool:
+        # Rebuilds accounts and meters from export_state() without any
+        # requests. The auth token is obtained from the refresh token on the
+        # first request that needs it.
+        if state.get("refresh_token") == None or len(state.get("accounts", [])) == 0:
+            return False
+
+        self.__reset_authentation()
+        self.auth['refresh']['token'] = state['refresh_token']
+        self.auth['refresh']['expires'] = state.get("refresh_expires")
+
+        self.__reset_accounts()
+        for account_state in state['accounts']:
+            account = EnergyAccount(self, account_state['number'])
+            for meter_state in account_state['meters']:
+                meter = account._add_meter(
+                    meter_state['type'],
+                    meter_state['id'],
+                    meter_state['serial'],
+                    meter_state.get("supply_point_id"),
+                    meter_state.get("property_id"),
+                    meter_state.get("registers")
+                )
+                meter.scheduler.restore_state(meter_state.get("schedule", {}))
+            self.accounts.append(account)
+
+        return True
+    
+
+    def get_meters(self) -> list:
+        meters = []
+        for account in self.accounts:
+            meters.extend(account.meters)
+        return meters
+    
+
+    async def update_tariffs(self, max_age: datetime.timedelta = None) -> list:
+        # Fetches the tariff agreements of every account whose cached ones are
+        # older than max_age (by default tariff_ttl), returning any errors
+        if max_age == None:
+            max_age = self.tariff_ttl
+
+        results = await self._gather([account.update_agreements(max_age) for account in self.accounts])
+
+        errors = []
+        for account, result in zip(self.accounts, results):
+            if isinstance(result, Exception):
+                _LOGGER.warning("Unable to update tariffs for account %s: %s", account.account_number, result)
+                errors.append(result)
+        return errors
+    
+
+    async def export_readings(self, path: str, export_format: str = export.FORMAT_CSV, meters: list = None, start = None, end = None, page_size: int = DEFAULT_HISTORY_PAGE_SIZE, resume: bool = True) -> int:
+        # Streams the reading history of the meters (by default all of them)
+        # to a CSV, JSON Lines or Parquet file, see export.export_readings()
+        if meters == None:
+            meters = self.get_meters()
+        return await export.export_readings(meters, path, export_format, start, end, page_size, resume)
+    
+
+    def __build_readings_batch(self, meters: list) -> tuple:
+        variables = {}
+        fields = []
+
+        for index, meter in enumerate(meters):
+            account_variable = "account" + str(index)
+            meter_variable = "meter" + str(index)
+
+            variables[account_variable] = meter.account.account_number
+            variables[meter_variable] = meter.meter_id
+            fields.append(("m" + str(index), meter.readings_field, account_variable, meter_variable))
+
+        return queries.batch_readings_query(fields), variables
+    
+
+    async def __update_meter_batch(self, meters: list) -> list:
+        # Returns the meters the batch could not answer, to be fetched one by one
+        query, variables = self.__build_readings_batch(meters)
+        try:
+            batch = await self._graphql_query(query, variables, decoder_args=(len(meters),))
+        except EonNextAuthenticationError:
+            raise
+        except EonNextGraphQLError as err:
+            self.__batch_supported = False
+            _LOGGER.info("Batched meter readings were rejected, falling back to per-meter requests: %s", err)
+            raise
+
+        unanswered = []
+        for meter, readings in zip(meters, batch):
+            if readings == None:
+                unanswered.append(meter)
+            else:
+                meter._store_readings(readings)
+        return unanswered
+    
+
+    async def update_meters(self, meters: list = None) -> list:
+        # Returns the exceptions of any meters which failed to update
+        if meters == None:
+            meters = self.get_meters()
+
+        pending = [meter for meter in meters if meter._should_update() == True]
+        errors = []
 
-                account = EnergyAccount(self, account_number)
-                await account._load_meters()
+        batchable = [meter for meter in pending if meter.readings_field != None]
+        if self.__batch_supported == True and self.__batch_size > 1 and len(batchable) > 1:
+            pending = [meter for meter in pending if meter.readings_field == None]
 
-                self.accounts.append(account)
+            batches = [batchable[index:index + self.__batch_size] for index in range(0, len(batchable), self.__batch_size)]
+            results = await self._gather([self.__update_meter_batch(batch) for batch in batches])
+
+            for batch, result in zip(batches, results):
+                if isinstance(result, (EonNextTransportError, EonNextUnavailable)):
+                    # Retrying each meter on its own would only hit the same
+                    # failing API again
+                    _LOGGER.warning("Unable to update meters: %s", result)
+                    errors.extend([result] * len(batch))
+                elif isinstance(result, Exception):
+                    _LOGGER.debug("Batched meter update failed, retrying per meter: %s", result)
+                    pending.extend(batch)
+                else:
+                    pending.extend(result)
+
+        results = await self._gather([meter.update() for meter in pending])
+
+        for meter, result in zip(pending, results):
+            if isinstance(result, Exception):
+                _LOGGER.warning("Unable to update meter %s: %s", meter.get_serial(), result)
+                errors.append(result)
+        return errors
 
 
 
@@ -196,39 +618,76 @@ class EnergyAccount:
     def __init__(self, api: EonNext, account_number: str):
         self.api = api
         self.account_number = account_number
+        self.meters = []
+
+        # Agreements by supply point (MPAN or MPRN), and when they were fetched
+        self.agreements = {}
+        self.agreements_updated = None
     
 
     async def _load_meters(self):
-        result = await self.api._graphql_post(
-            "getAccountMeterSelector",
-            "query getAccountMeterSelector($accountNumber: String!, $showInactive: Boolean!) {\n  properties(accountNumber: $accountNumber) {\n    ...MeterSelectorPropertyFields\n    __typename\n  }\n}\n\nfragment MeterSelectorPropertyFields on PropertyType {\n  __typename\n  electricityMeterPoints {\n    ...MeterSelectorElectricityMeterPointFields\n    __typename\n  }\n  gasMeterPoints {\n    ...MeterSelectorGasMeterPointFields\n    __typename\n  }\n  id\n  postcode\n}\n\nfragment MeterSelectorElectricityMeterPointFields on ElectricityMeterPointType {\n  __typename\n  id\n  meters(includeInactive: $showInactive) {\n    ...MeterSelectorElectricityMeterFields\n    __typename\n  }\n}\n\nfragment MeterSelectorElectricityMeterFields on ElectricityMeterType {\n  __typename\n  activeTo\n  id\n  registers {\n    id\n    name\n    __typename\n  }\n  serialNumber\n}\n\nfragment MeterSelectorGasMeterPointFields on GasMeterPointType {\n  __typename\n  id\n  meters(includeInactive: $showInactive) {\n    ...MeterSelectorGasMeterFields\n    __typename\n  }\n}\n\nfragment MeterSelectorGasMeterFields on GasMeterType {\n  __typename\n  activeTo\n  id\n  registers {\n    id\n    name\n    __typename\n  }\n  serialNumber\n}\n",
+        properties = await self.api._graphql_query(
+            queries.ACCOUNT_METERS,
             {
                 "accountNumber": self.account_number,
                 "showInactive": False
             }
         )
         
-        if self.api._json_contains_key_chain(result, ["data", "properties"]) == False:
-            raise Exception("Unable to load energy meters for account " + self.account_number)
-        
         self.meters = []
-        for property in result['data']['properties']:
+        for property_id, electricity_meters, gas_meters in properties:
 
-            for electricity_point in property['electricityMeterPoints']:
-                for meter_config in electricity_point['meters']:
-                    meter = ElectricityMeter(self, meter_config['id'], meter_config['serialNumber'])
-                    self.meters.append(meter)
+            for meter_id, serial, mpan, registers in electricity_meters:
+                self._add_meter(METER_TYPE_ELECTRIC, meter_id, serial, mpan, property_id, registers)
             
-            for gas_point in property['gasMeterPoints']:
-                for meter_config in gas_point['meters']:
-                    meter = GasMeter(self, meter_config['id'], meter_config['serialNumber'])
-                    self.meters.append(meter)
+            for meter_id, serial, mprn, registers in gas_meters:
+                self._add_meter(METER_TYPE_GAS, meter_id, serial, mprn, property_id, registers)
+    
+
+    async def update_agreements(self, max_age: datetime.timedelta = DEFAULT_TARIFF_TTL):
+        if self.agreements_updated != None and datetime.datetime.now() - self.agreements_updated < max_age:
+            return
+
+        agreements = await self.api._graphql_query(queries.AGREEMENTS, {"accountNumber": self.account_number})
+
+        self.agreements = agreements
+        self.agreements_updated = datetime.datetime.now()
+
+        for meter in self.meters:
+            meter.rate_table = RateTable(agreements[meter.supply_point_id]) if meter.supply_point_id in agreements else None
+    
+
+    def topology(self) -> list:
+        return sorted((self.account_number, meter.meter_id, meter.get_type(), meter.get_serial(), tuple(meter.registers)) for meter in self.meters)
+    
+
+    def _add_meter(self, meter_type: str, meter_id: str, serial: str, supply_point_id: str = None, property_id: str = None, registers: list = None):
+        if meter_type == METER_TYPE_ELECTRIC:
+            meter = ElectricityMeter(self, meter_id, serial)
+        elif meter_type == METER_TYPE_GAS:
+            meter = GasMeter(self, meter_id, serial)
+        else:
+            meter = EnergyMeter(self, meter_id, serial)
+
+        meter.supply_point_id = supply_point_id
+        meter.property_id = property_id
+        meter.registers = registers or []
+        self.meters.append(meter)
+        return meter
 
 
 
 
 class EnergyMeter:
 
+    # Name of the GraphQL field holding this meter type's readings, and the
+    # query used to page through them
+    readings_field = None
+    readings_query = None
+
+    # Key of the utility filter selecting this meter type's measurements
+    consumption_filter = None
+
     def __init__(self, account: EnergyAccount, meter_id: str, serial: str):
         self.account = account
         self.api = account.api
@@ -238,9 +697,27 @@ class EnergyMeter:
         self.type = METER_TYPE_UNKNOWN
         self.meter_id = meter_id
         self.serial = serial
+        self.scheduler = ReadingScheduler(meter_id)
 
         self.latest_reading = None
         self.latest_reading_date = None
+        self.latest_reading_id = None
+
+        # Register names from discovery, and the latest value of each
+        self.registers = []
+        self.latest_registers = {}
+
+        # Id of the newest reading handed out by iter_new_readings()
+        self.synced_reading_id = None
+
+        # Smart meter half-hourly consumption, found through the meter's
+        # supply point (MPAN or MPRN) on the property it belongs to
+        self.supply_point_id = None
+        self.property_id = None
+        self.consumption = IntervalSeries()
+
+        # Rates by day from the supply point's tariff agreements, once fetched
+        self.rate_table = None
     
 
     def get_type(self) -> str:
@@ -252,24 +729,176 @@ class EnergyMeter:
     
 
     def _should_update(self) -> bool:
-        if self.last_updated == None:
-            return True
-        
-        now = datetime.datetime.now()
-        if now.strftime("%d") != self.last_updated.strftime("%d"):
-            if now.hour >= 7:
-                return True
-        
-        return False
+        return self.scheduler.is_due()
+    
+
+    def request_refresh(self):
+        # The next update() fetches regardless of the schedule
+        self.scheduler.request_check()
 
 
-    def _convert_datetime_str_to_date(self, datetime_str: str) -> datetime.date:
-        date_chunks = str(datetime_str.split("T")[0]).split("-")
-        return datetime.date(int(date_chunks[0]), int(date_chunks[1]), int(date_chunks[2]))
+    def _store_readings(self, readings: list):
+        # readings are MeterReading records, newest first
+        self.last_updated = datetime.datetime.now()
+
+        if len(readings) > 0:
+            reading = readings[0]
+            self.latest_reading_id = reading.reading_id
+            # The first register, as the reading has always been, so the
+            # existing sensors' history keeps its meaning on multi-register
+            # meters; every register has its own sensor besides
+            if len(reading.registers) > 0:
+                self.latest_reading = round(reading.registers[0].value)
+            self.latest_reading_date = reading.read_at.date()
+            self.latest_registers = {register.name: register.value for register in reading.registers}
+
+        self.scheduler.record(self.latest_reading_date, self.last_updated)
+    
+
+    async def _readings_page(self, cursor: str = "", page_size: int = 1) -> decoders.ReadingsPage:
+        return await self.api._graphql_query(
+            self.readings_query,
+            {
+                "accountNumber": self.account.account_number,
+                "cursor": cursor,
+                "first": page_size,
+                "meterId": self.meter_id
+            }
+        )
     
 
     async def _update(self):
-        pass
+        if self.readings_query == None:
+            return
+
+        page = await self._readings_page()
+        self._store_readings(page.readings)
+    
+
+    async def iter_reading_pages(self, page_size: int = DEFAULT_HISTORY_PAGE_SIZE, cursor: str = ""):
+        # Yields (MeterReading records, cursor of the next page) a page at a
+        # time, newest first. The cursor is None with the last page.
+        if self.readings_query == None:
+            return
+
+        while True:
+            page = await self._readings_page(cursor, page_size)
+            yield page.readings, page.cursor
+            if page.cursor == None:
+                return
+            cursor = page.cursor
+    
+
+    async def iter_readings(self, page_size: int = DEFAULT_HISTORY_PAGE_SIZE, cursor: str = ""):
+        # Yields every reading as a MeterReading, newest first, fetching one
+        # page at a time so only a single page is ever held in memory
+        async for readings, next_cursor in self.iter_reading_pages(page_size, cursor):
+            for reading in readings:
+                yield reading
+    
+
+    async def iter_history(self, start = None, end = None, page_size: int = DEFAULT_HISTORY_PAGE_SIZE, cursor: str = ""):
+        # Yields (export rows, cursor of the next page) for readings taken
+        # from start (inclusive) until end (exclusive), a page at a time.
+        # Paging stops as soon as readings are older than start.
+        start = bound(start)
+        end = bound(end)
+
+        async for readings, next_cursor in self.iter_reading_pages(page_size, cursor):
+            rows = [row for row in export.reading_rows(self, readings) if (end == None or row['read_at'] < end) and (start == None or row['read_at'] >= start)]
+
+            if start != None and len(readings) > 0 and readings[-1].read_at_utc() < start:
+                yield rows, None
+                return
+
+            yield rows, next_cursor
+    
+
+    async def export_readings(self, path: str, export_format: str = export.FORMAT_CSV, start = None, end = None, page_size: int = DEFAULT_HISTORY_PAGE_SIZE, resume: bool = True) -> int:
+        return await export.export_readings([self], path, export_format, start, end, page_size, resume)
+    
+
+    def daily_costs(self, deltas: list) -> list:
+        # (day, kWh, cost in pence) for daily consumption as given by
+        # ReadingStore.daily_deltas(), or None before tariffs are known
+        if self.rate_table == None:
+            return None
+        return tariffs.daily_costs(deltas, self.rate_table)
+    
+
+    async def _consumption_page(self, start: datetime.datetime, end: datetime.datetime, cursor: str, page_size: int) -> tuple:
+        # ([(interval start, value, unit)], cursor of the next page)
+        return await self.api._graphql_query(
+            queries.CONSUMPTION,
+            {
+                "accountNumber": self.account.account_number,
+                "cursor": cursor,
+                "first": page_size,
+                "startAt": start.isoformat(),
+                "endAt": end.isoformat(),
+                "utilityFilters": [
+                    {
+                        self.consumption_filter: {
+                            "readingFrequencyType": "HALF_HOURLY",
+                            "marketSupplyPointId": self.supply_point_id
+                        }
+                    }
+                ]
+            },
+            decoder_args=(self.property_id,)
+        )
+    
+
+    async def iter_consumption(self, start: datetime.datetime, end: datetime.datetime, page_size: int = DEFAULT_CONSUMPTION_PAGE_SIZE):
+        # Yields (interval start, value, unit) for each half hour between
+        # start and end, one page at a time
+        if self.consumption_filter == None or self.supply_point_id == None:
+            return
+
+        cursor = None
+        while True:
+            intervals, cursor = await self._consumption_page(start, end, cursor, page_size)
+            for interval in intervals:
+                yield interval
+
+            if cursor == None:
+                return
+    
+
+    async def update_consumption(self, start: datetime.datetime = None, end: datetime.datetime = None, page_size: int = DEFAULT_CONSUMPTION_PAGE_SIZE) -> int:
+        # Adds intervals to self.consumption, by default only those after the
+        # last one already held. Returns how many intervals were added.
+        if end == None:
+            end = datetime.datetime.now(datetime.timezone.utc)
+        if start == None:
+            start = self.consumption.end() or end - DEFAULT_CONSUMPTION_BACKFILL
+
+        added = 0
+        async for interval_start, value, unit in self.iter_consumption(start, end, page_size):
+            if self.consumption.unit == None:
+                self.consumption.unit = unit
+            self.consumption.set(interval_start, value)
+            added = added + 1
+        return added
+    
+
+    async def iter_new_readings(self, page_size: int = DEFAULT_HISTORY_PAGE_SIZE, since_id: str = None):
+        # Yields only readings newer than since_id (by default the newest one
+        # seen by a previous sync), stopping as soon as it is reached. The
+        # sync point only moves once the new readings have all been consumed.
+        if since_id == None:
+            since_id = self.synced_reading_id
+
+        newest_id = None
+        async for reading in self.iter_readings(page_size):
+            if reading.reading_id == since_id:
+                break
+            if newest_id == None:
+                newest_id = reading.reading_id
+            yield reading
+
+        if newest_id != None:
+            self.synced_reading_id = newest_id
 
 
     async def update(self):
@@ -297,67 +926,45 @@ class EnergyMeter:
 
 class ElectricityMeter(EnergyMeter):
 
+    readings_field = "electricityMeterReadings"
+    consumption_filter = "electricityFilters"
+    readings_query = queries.ELECTRICITY_READINGS
+
     def __init__(self, account: EnergyAccount, meter_id: str, serial: str):
         super().__init__(account, meter_id, serial)
         self.type = METER_TYPE_ELECTRIC
-    
-
-    async def _update(self):
-        result = await self.api._graphql_post(
-            "meterReadingsHistoryTableElectricityReadings",
-            "query meterReadingsHistoryTableElectricityReadings($accountNumber: String!, $cursor: String, $meterId: String!) {\n  readings: electricityMeterReadings(\n    accountNumber: $accountNumber\n    after: $cursor\n    first: 12\n    meterId: $meterId\n  ) {\n    edges {\n      ...MeterReadingsHistoryTableElectricityMeterReadingConnectionTypeEdge\n      __typename\n    }\n    pageInfo {\n      endCursor\n      hasNextPage\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment MeterReadingsHistoryTableElectricityMeterReadingConnectionTypeEdge on ElectricityMeterReadingConnectionTypeEdge {\n  node {\n    id\n    readAt\n    readingSource\n    registers {\n      name\n      value\n      __typename\n    }\n    source\n    __typename\n  }\n  __typename\n}\n",
-            {
-                "accountNumber": self.account.account_number,
-                "cursor": "",
-                "meterId": self.meter_id
-            }
-        )
-
-        if self.api._json_contains_key_chain(result, ["data", "readings"]) == False:
-            raise Exception("Unable to load readings for meter " + self.serial)
-
-        readings = result['data']['readings']['edges']
-        if len(readings) > 0:
-            self.latest_reading = round(float(readings[0]['node']['registers'][0]['value']))
-            self.latest_reading_date = self._convert_datetime_str_to_date(readings[0]['node']['readAt'])
-            self.last_updated = datetime.datetime.now()
 
 
 
 class GasMeter(EnergyMeter):
 
+    readings_field = "gasMeterReadings"
+    consumption_filter = "gasFilters"
+    readings_query = queries.GAS_READINGS
+
     def __init__(self, account: EnergyAccount, meter_id: str, serial: str):
         super().__init__(account, meter_id, serial)
         self.type = METER_TYPE_GAS
+        self.latest_reading_kwh = None
     
 
-    async def _update(self):
-        result = await self.api._graphql_post(
-            "meterReadingsHistoryTableGasReadings",
-            "query meterReadingsHistoryTableGasReadings($accountNumber: String!, $cursor: String, $meterId: String!) {\n  readings: gasMeterReadings(\n    accountNumber: $accountNumber\n    after: $cursor\n    first: 12\n    meterId: $meterId\n  ) {\n    edges {\n      ...MeterReadingsHistoryTableGasMeterReadingConnectionTypeEdge\n      __typename\n    }\n    pageInfo {\n      endCursor\n      hasNextPage\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment MeterReadingsHistoryTableGasMeterReadingConnectionTypeEdge on GasMeterReadingConnectionTypeEdge {\n  node {\n    id\n    readAt\n    readingSource\n    registers {\n      name\n      value\n      __typename\n    }\n    source\n    __typename\n  }\n  __typename\n}\n",
-            {
-                "accountNumber": self.account.account_number,
-                "cursor": "",
-                "meterId": self.meter_id
-            }
-        )
+    def _store_readings(self, readings: list):
+        super()._store_readings(readings)
+        if self.latest_reading != None:
+            self.latest_reading_kwh = self._convert_m3_to_kwh(self.latest_reading, self.latest_reading_date)
+    
 
-        if self.api._json_contains_key_chain(result, ["data", "readings"]) == False:
-            raise Exception("Unable to load readings for meter " + self.serial)
+    def _convert_m3_to_kwh(self, m3: float, day: datetime.date = None) -> int:
+        return round(self.api.calorific_values.m3_to_kwh(m3, day))
+    
 
-        readings = result['data']['readings']['edges']
-        if len(readings) > 0:
-            self.latest_reading = round(float(readings[0]['node']['registers'][0]['value']))
-            self.latest_reading_date = self._convert_datetime_str_to_date(readings[0]['node']['readAt'])
-            self.last_updated = datetime.datetime.now()
+    def daily_costs(self, deltas: list) -> list:
+        # Deltas are in m³, converted with the calorific value of each day
+        if self.rate_table == None:
+            return None
+        return tariffs.daily_costs(deltas, self.rate_table, self.api.calorific_values)
     
 
     async def get_latest_reading_kwh(self) -> int:
-        m3 = await self.get_latest_reading()
-        gas_caloric_value = 38
-
-        kwh = m3 * 1.02264
-        kwh = kwh * gas_caloric_value
-        kwh = kwh / 3.6
-
-        return round(kwh)
+        await self.update()
+        return self.latest_reading_kwh
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import asyncio
+import csv
+import json
+import logging
+import os
+import re
+
+from .readings import bound
+
+_LOGGER = logging.getLogger(__name__)
+
+FORMAT_CSV = "csv"
+FORMAT_JSONL = "jsonl"
+FORMAT_PARQUET = "parquet"
+EXPORT_FORMATS = (FORMAT_CSV, FORMAT_JSONL, FORMAT_PARQUET)
+
+COLUMNS = ("meter_id", "serial", "meter_type", "reading_id", "read_at", "register", "value")
+
+CHECKPOINT_SUFFIX = ".checkpoint"
+CHECKPOINT_VERSION = 1
+
+# Names of the part files of a Parquet export, numbered by position
+PARQUET_PART = re.compile(r"part-(\d+)\.parquet")
+
+
+def write_file_atomically(path: str, text: str):
+    # Written aside and swapped in, so an interrupted write leaves the last one
+    temporary = path + ".tmp"
+    with open(temporary, "w") as file:
+        file.write(text)
+    os.replace(temporary, path)
+
+
+def reading_rows(meter, readings: list) -> list:
+    # One row per register of each MeterReading
+    rows = []
+    for reading in readings:
+        read_at = reading.read_at_utc()
+        for register in reading.registers:
+            rows.append({
+                "meter_id": meter.meter_id,
+                "serial": meter.get_serial(),
+                "meter_type": meter.get_type(),
+                "reading_id": reading.reading_id,
+                "read_at": read_at,
+                "register": register.name,
+                "value": register.value
+            })
+    return rows
+
+
+class _CsvWriter:
+
+    def __init__(self, path: str, position: int):
+        # Anything written after the last checkpoint is cut off, so a resumed
+        # export never repeats rows
+        self.file = open(path, "r+" if position > 0 else "w", newline="")
+        self.file.truncate(position)
+        self.file.seek(position)
+        self.writer = csv.DictWriter(self.file, COLUMNS)
+        if position == 0:
+            self.writer.writeheader()
+
+
+    def write(self, rows: list) -> int:
+        self.writer.writerows(rows)
+        self.file.flush()
+        return self.file.tell()
+
+
+    def close(self):
+        self.file.close()
+
+
+class _JsonLinesWriter:
+
+    def __init__(self, path: str, position: int):
+        self.file = open(path, "r+" if position > 0 else "w")
+        self.file.truncate(position)
+        self.file.seek(position)
+
+
+    def write(self, rows: list) -> int:
+        self.file.writelines(json.dumps(row) + "\n" for row in rows)
+        self.file.flush()
+        return self.file.tell()
+
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetWriter:
+    """Writes a directory of Parquet part files, one per page of readings,
+    which can be read as a single dataset."""
+
+    def __init__(self, path: str, position: int):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as err:
+            raise ImportError("Unable to export to Parquet, pyarrow is not installed") from err
+
+        self.pyarrow = pyarrow
+        self.parquet = pyarrow.parquet
+        self.path = path
+        self.parts = position
+
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            part = PARQUET_PART.fullmatch(name)
+            if part != None and int(part.group(1)) >= position:
+                os.remove(os.path.join(path, name))
+
+
+    def write(self, rows: list) -> int:
+        table = self.pyarrow.Table.from_pylist(rows)
+        self.parquet.write_table(table, os.path.join(self.path, "part-%05d.parquet" % self.parts))
+        self.parts = self.parts + 1
+        return self.parts
+
+
+    def close(self):
+        pass
+
+
+WRITERS = {
+    FORMAT_CSV: _CsvWriter,
+    FORMAT_JSONL: _JsonLinesWriter,
+    FORMAT_PARQUET: _ParquetWriter
+}
+
+
+def _open_writer(export_format: str, path: str, position: int):
+    folder = os.path.dirname(path)
+    if folder != "":
+        os.makedirs(folder, exist_ok=True)
+    return WRITERS[export_format](path, position)
+
+
+class ExportCheckpoint:
+    """Progress of an export, kept in a file next to it.
+
+    `position` is how much of the output is complete (a byte offset, or the
+    number of Parquet parts) and `meters` holds the cursor of the next page
+    for each meter, or whether it is done."""
+
+    def __init__(self, path: str, export_format: str, start: str, end: str):
+        self.path = path
+        self.format = export_format
+        self.start = start
+        self.end = end
+        self.position = 0
+        self.rows = 0
+        self.meters = {}
+
+
+    def load(self, output_path: str) -> bool:
+        # Picks up a previous run of the same export, returning whether there
+        # was one. If its output has gone since, the export starts afresh.
+        if os.path.exists(output_path) == False:
+            return False
+
+        try:
+            with open(self.path) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return False
+
+        if state.get("version") != CHECKPOINT_VERSION or [state.get("format"), state.get("start"), state.get("end")] != [self.format, self.start, self.end]:
+            return False
+
+        self.position = state['position']
+        self.rows = state['rows']
+        self.meters = state['meters']
+        return True
+
+
+    def save(self):
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "format": self.format,
+            "start": self.start,
+            "end": self.end,
+            "position": self.position,
+            "rows": self.rows,
+            "meters": self.meters
+        }
+        write_file_atomically(self.path, json.dumps(state))
+
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+async def export_readings(meters: list, path: str, export_format: str = FORMAT_CSV, start = None, end = None, page_size: int = 100, resume: bool = True, executor = None) -> int:
+    """Stream the reading history of the meters to a file.
+
+    Readings are fetched a page at a time and each page is written before the
+    next is requested, so memory use does not grow with the history. File
+    access runs in the executor. An interrupted export carries on from where
+    it stopped when run again with the same arguments. Returns the number of
+    rows in the file."""
+    if export_format not in WRITERS:
+        raise ValueError("Unknown export format " + str(export_format))
+
+    loop = asyncio.get_running_loop()
+    checkpoint = ExportCheckpoint(path + CHECKPOINT_SUFFIX, export_format, bound(start), bound(end))
+    if resume == True and await loop.run_in_executor(executor, checkpoint.load, path) == True:
+        _LOGGER.info("Resuming export to %s after %s rows", path, checkpoint.rows)
+
+    writer = await loop.run_in_executor(executor, _open_writer, export_format, path, checkpoint.position)
+    try:
+        for meter in meters:
+            progress = checkpoint.meters.get(meter.meter_id, {})
+            if progress.get("done") == True:
+                continue
+
+            async for rows, cursor in meter.iter_history(start, end, page_size, progress.get("cursor") or ""):
+                if len(rows) > 0:
+                    checkpoint.position = await loop.run_in_executor(executor, writer.write, rows)
+                    checkpoint.rows = checkpoint.rows + len(rows)
+
+                checkpoint.meters[meter.meter_id] = {"cursor": cursor, "done": cursor == None}
+                await loop.run_in_executor(executor, checkpoint.save)
+
+            checkpoint.meters[meter.meter_id] = {"cursor": None, "done": True}
+    finally:
+        await loop.run_in_executor(executor, writer.close)
+
+    await loop.run_in_executor(executor, checkpoint.remove)
+    return checkpoint.rows
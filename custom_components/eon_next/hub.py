@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.event import async_track_time_interval
+
+from .const import DOMAIN
+from .coordinator import UPDATE_INTERVAL
+from .eonnext import EonNext
+from .reading_store import ReadingStore
+from .transport import SHARED_CIRCUIT_BREAKER, SHARED_RATE_LIMITER
+
+_LOGGER = logging.getLogger(__name__)
+
+READING_STORE_FILE = "eon_next.db"
+
+
+def async_get_hub(hass):
+    """Return the hub shared by every config entry, creating it if needed."""
+    if DOMAIN not in hass.data:
+        hass.data[DOMAIN] = EonNextHub(hass)
+    return hass.data[DOMAIN]
+
+
+class EonNextHub:
+    """Everything shared between config entries.
+
+    All clients use one connection pool, rate limiter and circuit breaker,
+    and one reading store. A single timer refreshes every entry. An account
+    visible from more than one login is only handled by the first entry to
+    claim it, so its meters are fetched once."""
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.session = async_get_clientsession(hass)
+        self.reading_store = ReadingStore(hass.config.path(READING_STORE_FILE))
+
+        self.coordinators = {}
+        self.account_owners = {}
+        self.deferred_accounts = {}
+        self.__unsub_refresh = None
+
+
+    def create_client(self, **kwargs) -> EonNext:
+        return EonNext(self.session, rate_limiter=SHARED_RATE_LIMITER, circuit_breaker=SHARED_CIRCUIT_BREAKER, **kwargs)
+
+
+    def claim_accounts(self, entry_id: str, api: EonNext):
+        """Set aside any of the client's accounts which another entry already handles."""
+        kept = []
+        deferred = []
+
+        for account in api.accounts + api.deferred_accounts:
+            owner = self.account_owners.get(account.account_number)
+            if owner == None or owner == entry_id or owner not in self.coordinators:
+                self.account_owners[account.account_number] = entry_id
+                kept.append(account)
+            else:
+                _LOGGER.debug("Account %s is already handled by another Eon Next login", account.account_number)
+                deferred.append(account)
+
+        # Deferred accounts stay in the client's cached state, so a reload
+        # after their owner goes takes them over without rediscovery
+        api.accounts = kept
+        api.deferred_accounts = deferred
+        self.deferred_accounts[entry_id] = set(account.account_number for account in deferred)
+
+
+    def register(self, entry_id: str, coordinator):
+        self.coordinators[entry_id] = coordinator
+        if self.__unsub_refresh == None:
+            self.__unsub_refresh = async_track_time_interval(self.hass, self._async_refresh_all, UPDATE_INTERVAL)
+
+
+    async def async_unregister(self, entry_id: str):
+        self.coordinators.pop(entry_id, None)
+        self.deferred_accounts.pop(entry_id, None)
+
+        released = set()
+        for account_number, owner in list(self.account_owners.items()):
+            if owner == entry_id:
+                del self.account_owners[account_number]
+                released.add(account_number)
+
+        if len(self.coordinators) == 0:
+            if self.__unsub_refresh != None:
+                self.__unsub_refresh()
+                self.__unsub_refresh = None
+            await self.hass.async_add_executor_job(self.reading_store.close)
+            return
+
+        # Entries which stood aside for accounts this one handled take them
+        # over by reloading
+        for other_entry_id, deferred in list(self.deferred_accounts.items()):
+            if len(deferred & released) > 0:
+                self.hass.async_create_task(self.hass.config_entries.async_reload(other_entry_id))
+
+
+    def meters(self) -> list:
+        meters = []
+        for coordinator in self.coordinators.values():
+            meters.extend(coordinator.meters())
+        return meters
+
+
+    async def _async_refresh_all(self, now=None):
+        await asyncio.gather(*[coordinator.async_refresh() for coordinator in list(self.coordinators.values())])
+
+
+    async def async_refresh_meters(self):
+        """Fetch every meter of every entry now, regardless of its schedule."""
+        await asyncio.gather(*[coordinator.async_refresh_meters() for coordinator in list(self.coordinators.values())])
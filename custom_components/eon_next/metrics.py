@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import collections
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+CALL_RATE_WINDOW = 3600
+
+EVENT_REQUEST = "request"
+EVENT_TOKEN_REFRESH = "token_refresh"
+
+
+class OperationMetrics:
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # Time spent parsing responses and turning them into models, which
+        # is also in total_time
+        self.decode_time = 0.0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+
+
+    def record(self, duration: float, bytes_sent: int, bytes_received: int, error: bool, decode_time: float = 0.0):
+        self.calls = self.calls + 1
+        self.decode_time = self.decode_time + decode_time
+        self.bytes_sent = self.bytes_sent + bytes_sent
+        self.bytes_received = self.bytes_received + bytes_received
+        self.total_time = self.total_time + duration
+        self.max_time = max(self.max_time, duration)
+        if error == True:
+            self.errors = self.errors + 1
+
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                self.histogram[index] = self.histogram[index] + 1
+                break
+
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "mean_seconds": self.total_time / self.calls if self.calls > 0 else 0.0,
+            "max_seconds": self.max_time,
+            "decode_seconds": self.decode_time,
+            "histogram": {str(bound): count for bound, count in zip(LATENCY_BUCKETS, self.histogram)}
+        }
+
+
+class ApiMetrics:
+    """Counters and latency histograms per GraphQL operation, plus token
+    refresh events. Callers can register hooks to be told of each event as
+    it happens."""
+
+    def __init__(self):
+        self.operations = {}
+        self.token_refreshes = {}
+        self.token_refresh_failures = 0
+        self.__recent_calls = collections.deque()
+        self.__hooks = []
+
+
+    def add_hook(self, hook):
+        # hook(event, details) is called for every request and token refresh.
+        # Returns a function which removes the hook again.
+        self.__hooks.append(hook)
+        return lambda: self.__hooks.remove(hook)
+
+
+    def __notify(self, event: str, details: dict):
+        for hook in list(self.__hooks):
+            try:
+                hook(event, details)
+            except Exception:
+                _LOGGER.exception("Error in Eon Next metrics hook")
+
+
+    def record_request(self, operation: str, duration: float, bytes_sent: int = 0, bytes_received: int = 0, error: str = None, decode_time: float = 0.0):
+        if operation not in self.operations:
+            self.operations[operation] = OperationMetrics()
+        self.operations[operation].record(duration, bytes_sent, bytes_received, error != None, decode_time)
+
+        now = time.monotonic()
+        self.__recent_calls.append(now)
+        while self.__recent_calls[0] < now - CALL_RATE_WINDOW:
+            self.__recent_calls.popleft()
+
+        if len(self.__hooks) > 0:
+            self.__notify(EVENT_REQUEST, {
+                "operation": operation,
+                "duration": duration,
+                "bytes_sent": bytes_sent,
+                "bytes_received": bytes_received,
+                "error": error
+            })
+
+
+    def record_error(self, operation: str, error: str):
+        # An error found in a response which was already recorded as a request
+        if operation not in self.operations:
+            self.operations[operation] = OperationMetrics()
+        self.operations[operation].errors = self.operations[operation].errors + 1
+
+
+    def record_decode(self, operation: str, duration: float):
+        # Time taken to turn a response, already recorded as a request, into models
+        if operation not in self.operations:
+            self.operations[operation] = OperationMetrics()
+        self.operations[operation].decode_time = self.operations[operation].decode_time + duration
+
+
+    def record_token_refresh(self, method: str, success: bool):
+        self.token_refreshes[method] = self.token_refreshes.get(method, 0) + 1
+        if success == False:
+            self.token_refresh_failures = self.token_refresh_failures + 1
+
+        if len(self.__hooks) > 0:
+            self.__notify(EVENT_TOKEN_REFRESH, {"method": method, "success": success})
+
+
+    def calls_last_hour(self) -> int:
+        now = time.monotonic()
+        while len(self.__recent_calls) > 0 and self.__recent_calls[0] < now - CALL_RATE_WINDOW:
+            self.__recent_calls.popleft()
+        return len(self.__recent_calls)
+
+
+    def as_dict(self) -> dict:
+        return {
+            "operations": {operation: metrics.as_dict() for operation, metrics in self.operations.items()},
+            "token_refreshes": dict(self.token_refreshes),
+            "token_refresh_failures": self.token_refresh_failures,
+            "calls_last_hour": self.calls_last_hour()
+        }
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import hashlib
+
+# Batched queries are built per set of meters, so their documents are
+# remembered up to this many at a time to avoid hashing them on every refresh
+DOCUMENT_CACHE_SIZE = 64
+
+BATCH_READINGS_OPERATION = "batchMeterReadings"
+
+
+class PersistedQuery:
+    """A named GraphQL document and the SHA-256 hash it is persisted under."""
+
+    def __init__(self, operation: str, document: str):
+        self.operation = operation
+        self.document = document
+        self.sha256 = hashlib.sha256(document.encode()).hexdigest()
+
+
+    def payload(self, variables: dict, include_document: bool = True, persisted: bool = True) -> dict:
+        payload = {"operationName": self.operation, "variables": variables}
+        if include_document == True:
+            payload['query'] = self.document
+        if persisted == True:
+            payload['extensions'] = {"persistedQuery": {"version": 1, "sha256Hash": self.sha256}}
+        return payload
+
+
+QUERIES = {}
+_documents = {}
+
+
+def register(operation: str, document: str) -> PersistedQuery:
+    query = PersistedQuery(operation, document)
+    QUERIES[operation] = query
+    return query
+
+
+def document_query(operation: str, document: str) -> PersistedQuery:
+    # For documents built at runtime, which are not in the registry
+    query = _documents.get(document)
+    if query == None:
+        if len(_documents) >= DOCUMENT_CACHE_SIZE:
+            _documents.pop(next(iter(_documents)))
+        query = PersistedQuery(operation, document)
+        _documents[document] = query
+    return query
+
+
+# Only the fields the client reads are requested
+
+LOGIN = register(
+    "loginEmailAuthentication",
+    "mutation loginEmailAuthentication($input: ObtainJSONWebTokenInput!) {\n"
+    "  obtainKrakenToken(input: $input) {\n    payload\n    refreshExpiresIn\n    refreshToken\n    token\n  }\n"
+    "}\n"
+)
+
+REFRESH_TOKEN = register(
+    "refreshToken",
+    "mutation refreshToken($input: ObtainJSONWebTokenInput!) {\n"
+    "  obtainKrakenToken(input: $input) {\n    payload\n    refreshExpiresIn\n    refreshToken\n    token\n  }\n"
+    "}\n"
+)
+
+ACCOUNT_NUMBERS = register(
+    "headerGetLoggedInUser",
+    "query headerGetLoggedInUser {\n"
+    "  viewer {\n    accounts {\n      number\n    }\n  }\n"
+    "}\n"
+)
+
+ACCOUNT_METERS = register(
+    "getAccountMeterSelector",
+    "query getAccountMeterSelector($accountNumber: String!, $showInactive: Boolean!) {\n"
+    "  properties(accountNumber: $accountNumber) {\n"
+    "    id\n"
+    "    electricityMeterPoints {\n      mpan\n      meters(includeInactive: $showInactive) {\n        id\n        serialNumber\n        registers {\n          name\n        }\n      }\n    }\n"
+    "    gasMeterPoints {\n      mprn\n      meters(includeInactive: $showInactive) {\n        id\n        serialNumber\n        registers {\n          name\n        }\n      }\n    }\n"
+    "  }\n"
+    "}\n"
+)
+
+READINGS_FIELDS = (
+    "    edges {\n      node {\n        id\n        readAt\n        source\n        registers {\n          name\n          value\n        }\n      }\n    }\n"
+)
+
+ELECTRICITY_READINGS = register(
+    "meterReadingsHistoryTableElectricityReadings",
+    "query meterReadingsHistoryTableElectricityReadings($accountNumber: String!, $cursor: String, $first: Int!, $meterId: String!) {\n"
+    "  readings: electricityMeterReadings(accountNumber: $accountNumber, after: $cursor, first: $first, meterId: $meterId) {\n"
+    + READINGS_FIELDS +
+    "    pageInfo {\n      endCursor\n      hasNextPage\n    }\n"
+    "  }\n"
+    "}\n"
+)
+
+GAS_READINGS = register(
+    "meterReadingsHistoryTableGasReadings",
+    "query meterReadingsHistoryTableGasReadings($accountNumber: String!, $cursor: String, $first: Int!, $meterId: String!) {\n"
+    "  readings: gasMeterReadings(accountNumber: $accountNumber, after: $cursor, first: $first, meterId: $meterId) {\n"
+    + READINGS_FIELDS +
+    "    pageInfo {\n      endCursor\n      hasNextPage\n    }\n"
+    "  }\n"
+    "}\n"
+)
+
+CONSUMPTION = register(
+    "getSmartMeterConsumption",
+    "query getSmartMeterConsumption($accountNumber: String!, $cursor: String, $first: Int!, $startAt: DateTime!, $endAt: DateTime!, $utilityFilters: [UtilityFiltersInput!]) {\n"
+    "  account(accountNumber: $accountNumber) {\n"
+    "    properties {\n"
+    "      id\n"
+    "      measurements(after: $cursor, first: $first, startAt: $startAt, endAt: $endAt, utilityFilters: $utilityFilters) {\n"
+    "        edges {\n          node {\n            value\n            unit\n            ... on IntervalMeasurementType {\n              startAt\n              endAt\n            }\n          }\n        }\n"
+    "        pageInfo {\n          endCursor\n          hasNextPage\n        }\n"
+    "      }\n"
+    "    }\n"
+    "  }\n"
+    "}\n"
+)
+
+
+AGREEMENTS = register(
+    "getAccountAgreements",
+    "query getAccountAgreements($accountNumber: String!) {\n"
+    "  account(accountNumber: $accountNumber) {\n"
+    "    electricityAgreements {\n"
+    "      validFrom\n      validTo\n      meterPoint {\n        mpan\n      }\n"
+    "      tariff {\n"
+    "        ... on StandardTariff {\n          unitRate\n          standingCharge\n        }\n"
+    "        ... on PrepayTariff {\n          unitRate\n          standingCharge\n        }\n"
+    "      }\n"
+    "    }\n"
+    "    gasAgreements {\n"
+    "      validFrom\n      validTo\n      meterPoint {\n        mprn\n      }\n"
+    "      tariff {\n        unitRate\n        standingCharge\n      }\n"
+    "    }\n"
+    "  }\n"
+    "}\n"
+)
+
+
+def batch_readings_query(fields: list) -> PersistedQuery:
+    # fields is (alias, readings field, account variable, meter variable) for
+    # each meter, giving the document and its variable declarations
+    arguments = []
+    selections = []
+    for alias, readings_field, account_variable, meter_variable in fields:
+        arguments.append("$" + account_variable + ": String!, $" + meter_variable + ": String!")
+        selections.append(
+            "  " + alias + ": " + readings_field + "(accountNumber: $" + account_variable + ", meterId: $" + meter_variable + ", first: 1) {\n"
+            + READINGS_FIELDS +
+            "  }\n"
+        )
+
+    return document_query(BATCH_READINGS_OPERATION, "query " + BATCH_READINGS_OPERATION + "(" + ", ".join(arguments) + ") {\n" + "".join(selections) + "}\n")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import datetime
+import sqlite3
+import threading
+
+from .readings import bound
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS readings (
+    id TEXT NOT NULL,
+    meter_id TEXT NOT NULL,
+    read_at TEXT NOT NULL,
+    register TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (id, register)
+);
+CREATE INDEX IF NOT EXISTS readings_meter_read_at ON readings (meter_id, read_at);
+CREATE TABLE IF NOT EXISTS sync_state (
+    meter_id TEXT PRIMARY KEY,
+    synced_id TEXT,
+    pending_id TEXT,
+    cursor TEXT
+);
+"""
+
+UPSERT = """
+INSERT INTO readings (id, meter_id, read_at, register, value) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (id, register) DO UPDATE SET meter_id = excluded.meter_id, read_at = excluded.read_at, value = excluded.value
+"""
+
+# Last value of each register per period, summed across registers, then the
+# difference from the previous period
+PERIOD_DELTAS = """
+WITH period_registers AS (
+    SELECT substr(read_at, 1, ?) AS period, register, MAX(value) AS value
+    FROM readings
+    WHERE meter_id = ? AND read_at >= ? AND read_at < ?
+    GROUP BY period, register
+), period_totals AS (
+    SELECT period, SUM(value) AS value FROM period_registers GROUP BY period
+)
+SELECT period, value - LAG(value) OVER (ORDER BY period) FROM period_totals ORDER BY period
+"""
+
+PERIOD_DAY = 10
+PERIOD_MONTH = 7
+
+
+class ReadingStore:
+    """Every reading of every meter in a local SQLite database.
+
+    The methods block, so from an event loop they should be run in an
+    executor. A single connection is shared between threads behind a lock."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__connection = None
+        self.__lock = threading.Lock()
+    
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__connection == None:
+            self.__connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.__connection.execute("PRAGMA journal_mode=WAL")
+            self.__connection.executescript(SCHEMA)
+        return self.__connection
+    
+
+    def close(self):
+        with self.__lock:
+            if self.__connection != None:
+                self.__connection.close()
+                self.__connection = None
+    
+
+    def upsert_readings(self, meter_id: str, readings: list) -> int:
+        # Takes MeterReading records, one row per register. Readings already
+        # stored, identified by their id, are replaced.
+        rows = []
+        for reading in readings:
+            read_at = reading.read_at_utc()
+            for register in reading.registers:
+                rows.append((reading.reading_id, meter_id, read_at, register.name, register.value))
+
+        with self.__lock:
+            connection = self.__connect()
+            with connection:
+                connection.executemany(UPSERT, rows)
+        return len(rows)
+    
+
+    def sync_state(self, meter_id: str) -> tuple:
+        # (newest reading id of the last complete sync, newest reading id of
+        # a sync still in progress, cursor of its next page), all None for a
+        # meter never synced
+        with self.__lock:
+            row = self.__connect().execute(
+                "SELECT synced_id, pending_id, cursor FROM sync_state WHERE meter_id = ?",
+                (meter_id,)
+            ).fetchone()
+        return (None, None, None) if row == None else tuple(row)
+    
+
+    def save_sync_state(self, meter_id: str, synced_id: str, pending_id: str = None, cursor: str = None):
+        with self.__lock:
+            connection = self.__connect()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO sync_state (meter_id, synced_id, pending_id, cursor) VALUES (?, ?, ?, ?)",
+                    (meter_id, synced_id, pending_id, cursor)
+                )
+    
+
+    def readings(self, meter_id: str, start: datetime.date = None, end: datetime.date = None, register: str = None) -> list:
+        # (read_at, register, value) tuples between start (inclusive) and end
+        # (exclusive), oldest first
+        query = "SELECT read_at, register, value FROM readings WHERE meter_id = ? AND read_at >= ? AND read_at < ?"
+        parameters = [meter_id, bound(start) or "", bound(end) or "9999"]
+        if register != None:
+            query += " AND register = ?"
+            parameters.append(register)
+        query += " ORDER BY read_at, register"
+
+        with self.__lock:
+            return self.__connect().execute(query, parameters).fetchall()
+    
+
+    def totals(self, meter_id: str, start: datetime.datetime = None, end: datetime.datetime = None) -> list:
+        # (read_at, sum of every register) for each reading after start and
+        # before end, oldest first
+        with self.__lock:
+            return self.__connect().execute(
+                "SELECT read_at, SUM(value) FROM readings WHERE meter_id = ? AND read_at > ? AND read_at < ? GROUP BY id, read_at ORDER BY read_at",
+                (meter_id, bound(start) or "", bound(end) or "9999")
+            ).fetchall()
+    
+
+    def __period_deltas(self, period_length: int, meter_id: str, start: datetime.date = None, end: datetime.date = None) -> list:
+        with self.__lock:
+            rows = self.__connect().execute(
+                PERIOD_DELTAS,
+                (period_length, meter_id, bound(start) or "", bound(end) or "9999")
+            ).fetchall()
+
+        # The first period has nothing before it to compare against
+        return [(period, delta) for period, delta in rows if delta != None]
+    
+
+    def daily_deltas(self, meter_id: str, start: datetime.date = None, end: datetime.date = None) -> list:
+        # (YYYY-MM-DD, consumption since the previous day with a reading)
+        return self.__period_deltas(PERIOD_DAY, meter_id, start, end)
+    
+
+    def monthly_deltas(self, meter_id: str, start: datetime.date = None, end: datetime.date = None) -> list:
+        # (YYYY-MM, consumption since the previous month with a reading)
+        return self.__period_deltas(PERIOD_MONTH, meter_id, start, end)
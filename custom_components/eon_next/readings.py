@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import datetime
+
+
+def utc_read_at(read_at: datetime.datetime) -> str:
+    # UTC ISO 8601 without an offset, as the reading store keeps them, so
+    # that string order is time order. Naive times are taken to be UTC.
+    if read_at.tzinfo != None:
+        read_at = read_at.astimezone(datetime.timezone.utc)
+    return read_at.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def bound(value) -> str:
+    # A date or datetime as a string comparable with utc_read_at(), or None
+    if value == None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return utc_read_at(value)
+    return value.isoformat()
+
+
+class RegisterReading:
+    """Value of one register, such as "Day" or "Night" on an Economy 7 meter."""
+
+    __slots__ = ("name", "value")
+
+    def __init__(self, name: str, value: float):
+        self.name = name
+        self.value = value
+
+
+    def __repr__(self) -> str:
+        return "RegisterReading(%r, %r)" % (self.name, self.value)
+
+
+class MeterReading:
+    """One meter reading with every register. Slots keep a long history to a
+    fraction of the size of the response dicts it is parsed from."""
+
+    __slots__ = ("reading_id", "read_at", "source", "registers")
+
+    def __init__(self, reading_id: str, read_at: datetime.datetime, source: str, registers: tuple):
+        self.reading_id = reading_id
+        self.read_at = read_at
+        self.source = source
+        self.registers = registers
+
+
+    def __repr__(self) -> str:
+        return "MeterReading(%r, %r, %r, %r)" % (self.reading_id, self.read_at, self.source, self.registers)
+
+
+    def register(self, name: str) -> float:
+        for register in self.registers:
+            if register.name == name:
+                return register.value
+        return None
+
+
+    def read_at_utc(self) -> str:
+        return utc_read_at(self.read_at)
+
+
+def parse_reading(node: dict) -> MeterReading:
+    return MeterReading(
+        node['id'],
+        datetime.datetime.fromisoformat(node['readAt']),
+        node.get("source"),
+        tuple(RegisterReading(register['name'], float(register['value'])) for register in node['registers'])
+    )
+
+
+def parse_readings(edges: list) -> list:
+    # Reading records from a connection's edges, in one pass
+    return [parse_reading(edge['node']) for edge in edges]
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import collections
+import datetime
+import hashlib
+import statistics
+
+DEFAULT_BASE_INTERVAL = datetime.timedelta(hours=1)
+DEFAULT_MAX_INTERVAL = datetime.timedelta(hours=12)
+DEFAULT_MAX_JITTER = datetime.timedelta(minutes=30)
+DEFAULT_HISTORY_SIZE = 14
+
+# Until a meter's own pattern has been seen, readings are assumed to be daily
+# and to turn up from 07:00
+DEFAULT_ARRIVAL_MINUTE = 7 * 60
+DEFAULT_INTERVAL_DAYS = 1
+
+
+class ReadingScheduler:
+    """Decides when a meter is next worth asking for new readings.
+
+    It learns the time of day new readings turn up and how many days apart
+    their readAt dates are, and checks again shortly after the next one is
+    expected. Each check that finds nothing new doubles the wait, up to
+    max_interval. A fixed per-meter jitter spreads meters out so they do
+    not all hit the API at the same moment."""
+
+    def __init__(self, key: str, base_interval: datetime.timedelta = DEFAULT_BASE_INTERVAL, max_interval: datetime.timedelta = DEFAULT_MAX_INTERVAL, max_jitter: datetime.timedelta = DEFAULT_MAX_JITTER, history_size: int = DEFAULT_HISTORY_SIZE):
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+
+        # Derived from the key rather than random so it survives restarts
+        digest = int(hashlib.sha256(key.encode()).hexdigest()[:8], 16)
+        self.jitter = datetime.timedelta(seconds=digest % max(int(max_jitter.total_seconds()), 1))
+
+        self.arrivals = collections.deque(maxlen=history_size)
+        self.intervals = collections.deque(maxlen=history_size)
+        self.last_read_at = None
+        self.last_arrival = None
+        self.misses = 0
+        self.next_check = None
+    
+
+    def is_due(self, now: datetime.datetime = None) -> bool:
+        if self.next_check == None:
+            return True
+        if now == None:
+            now = datetime.datetime.now()
+        return now >= self.next_check
+    
+
+    def request_check(self):
+        # Makes the meter due straight away, e.g. for an on-demand refresh
+        self.next_check = None
+    
+
+    def expected_arrival(self, after: datetime.datetime = None) -> datetime.datetime:
+        # When the next reading should turn up. If that has already passed
+        # without one, the arrival after that, and so on, until after `after`.
+        if self.last_arrival == None:
+            return None
+
+        arrival_minute = statistics.median(self.arrivals) if len(self.arrivals) > 0 else DEFAULT_ARRIVAL_MINUTE
+        interval_days = statistics.median(self.intervals) if len(self.intervals) > 0 else DEFAULT_INTERVAL_DAYS
+        interval = datetime.timedelta(days=max(round(interval_days), 1))
+
+        day = self.last_arrival.date() + interval
+        expected = datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(minutes=arrival_minute) + self.jitter
+        while after != None and expected <= after:
+            expected = expected + interval
+        return expected
+    
+
+    def record(self, read_at: datetime.date, now: datetime.datetime = None):
+        # Called after every check with the readAt date of the newest reading
+        # found, or None if the meter has no readings
+        if now == None:
+            now = datetime.datetime.now()
+
+        if read_at != None and (self.last_read_at == None or read_at > self.last_read_at):
+            if self.last_read_at != None:
+                # Only a reading seen to change while polling says anything
+                # about when readings arrive, the first one found does not
+                self.intervals.append((read_at - self.last_read_at).days)
+                self.arrivals.append(now.hour * 60 + now.minute)
+            self.last_read_at = read_at
+            self.last_arrival = now
+            self.misses = 0
+            self.next_check = self.expected_arrival()
+            return
+
+        self.misses = self.misses + 1
+        backoff = min(self.base_interval * (2 ** (self.misses - 1)), self.max_interval)
+        self.next_check = now + backoff + self.jitter
+
+        # Never back off past the time the next reading is expected
+        expected = self.expected_arrival(now)
+        if expected != None and expected < self.next_check:
+            self.next_check = expected
+    
+
+    def export_state(self) -> dict:
+        return {
+            "arrivals": list(self.arrivals),
+            "intervals": list(self.intervals),
+            "last_read_at": None if self.last_read_at == None else self.last_read_at.isoformat(),
+            "last_arrival": None if self.last_arrival == None else self.last_arrival.isoformat()
+        }
+    
+
+    def restore_state(self, state: dict):
+        self.arrivals.extend(state.get("arrivals", []))
+        self.intervals.extend(state.get("intervals", []))
+        if state.get("last_read_at") != None:
+            self.last_read_at = datetime.date.fromisoformat(state['last_read_at'])
+        if state.get("last_arrival") != None:
+            self.last_arrival = datetime.datetime.fromisoformat(state['last_arrival'])
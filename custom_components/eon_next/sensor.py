@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
 
 import logging
+import re
 
 from homeassistant.components.sensor import (
+    RestoreSensor,
     SensorDeviceClass,
     SensorEntity
 )
 
 from homeassistant.const import (
+    EntityCategory,
     UnitOfEnergy,
+    UnitOfTime,
     UnitOfVolume
 )
 
-from . import DOMAIN
+from homeassistant.core import callback
+from homeassistant.util import dt as dt_util
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
+
+from .const import CURRENCY, DOMAIN
 from .eonnext import METER_TYPE_GAS, METER_TYPE_ELECTRIC
+from .timeseries import LOCAL_TIMEZONE
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -21,48 +30,133 @@ _LOGGER = logging.getLogger(__name__)
 async def async_setup_entry(hass, config_entry, async_add_entities):
     """Setup sensors from a config entry created in the integrations UI."""
 
-    api = hass.data[DOMAIN][config_entry.entry_id]
+    coordinator = hass.data[DOMAIN].coordinators[config_entry.entry_id]
 
+    # Sensors come from the known meters rather than their readings, which
+    # may not have been fetched yet
     entities = []
-    for account in api.accounts:
-        for meter in account.meters:
-            if await meter.has_reading() == True:
+    for meter in coordinator.meters():
+        entities.append(LatestReadingDateSensor(coordinator, meter))
 
-                entities.append(LatestReadingDateSensor(meter))
+        if meter.get_type() == METER_TYPE_ELECTRIC:
+            entities.append(LatestElectricKwhSensor(coordinator, meter))
+        
+        if meter.get_type() == METER_TYPE_GAS:
+            entities.append(LatestGasCubicMetersSensor(coordinator, meter))
+            entities.append(LatestGasKwhSensor(coordinator, meter))
 
-                if meter.get_type() == METER_TYPE_ELECTRIC:
-                    entities.append(LatestElectricKwhSensor(meter))
-                
-                if meter.get_type() == METER_TYPE_GAS:
-                    entities.append(LatestGasCubicMetersSensor(meter))
-                    entities.append(LatestGasKwhSensor(meter))
+        # Multi-rate meters, such as Economy 7, also get a sensor per register
+        if len(meter.registers) > 1:
+            for register in meter.registers:
+                entities.append(RegisterReadingSensor(coordinator, meter, register))
 
-    async_add_entities(entities, update_before_add=True)
+    entities.append(LastRefreshDurationSensor(coordinator, config_entry))
+    entities.append(ApiCallsPerHourSensor(coordinator, config_entry))
 
+    async_add_entities(entities)
 
+    # Smart meters only turn out to have half-hourly data once it has been
+    # fetched, and whether a meter's tariff can be costed once its tariffs
+    # have been, so those sensors are added as that happens
+    consumption_meters = set()
+    costed_meters = set()
 
-class LatestReadingDateSensor(SensorEntity):
-    """Date of latest meter reading"""
+    @callback
+    def async_add_discovered_sensors():
+        new_entities = []
+        for meter in coordinator.meters():
+            if meter.meter_id not in consumption_meters and len(meter.consumption) > 0:
+                consumption_meters.add(meter.meter_id)
+                new_entities.append(ConsumptionTodaySensor(coordinator, meter))
+
+            if meter.meter_id not in costed_meters and meter.rate_table != None and meter.rate_table.has_unit_rate() == True:
+                costed_meters.add(meter.meter_id)
+                new_entities.append(CostSensor(coordinator, meter))
+
+        if len(new_entities) > 0:
+            async_add_entities(new_entities)
+
+    async_add_discovered_sensors()
+    config_entry.async_on_unload(coordinator.async_add_listener(async_add_discovered_sensors))
+
+
+
+class EonNextSensor(CoordinatorEntity, SensorEntity):
+    """Sensor which is pushed new values by the coordinator"""
+
+    _attr_should_poll = False
 
-    def __init__(self, meter):
+    def __init__(self, coordinator, value):
+        # value returns the sensor's current value from the coordinator's data
+        super().__init__(coordinator)
+        self._value = value
+        self._attr_native_value = self._value()
+        self._last_available = None
+    
+
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        value = self._value()
+        available = self.available
+
+        if value == self._attr_native_value and available == self._last_available:
+            return
+
+        self._attr_native_value = value
+        self._last_available = available
+        self.async_write_ha_state()
+
+
+
+class EonNextMeterSensor(EonNextSensor, RestoreSensor):
+    """Sensor for one meter, showing its last known state until readings arrive"""
+
+    def __init__(self, coordinator, meter, value):
         self.meter = meter
+        super().__init__(coordinator, value)
+    
+
+    async def async_added_to_hass(self) -> None:
+        await super().async_added_to_hass()
+
+        if self._attr_native_value == None:
+            last_data = await self.async_get_last_sensor_data()
+            if last_data != None:
+                self._attr_native_value = last_data.native_value
+    
+
+    @property
+    def available(self) -> bool:
+        return super().available and self._attr_native_value != None
+    
+
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        # A restored value is kept until the meter has been fetched
+        if self._value() == None and self._attr_native_value != None:
+            return
+        super()._handle_coordinator_update()
+
+
+
+class LatestReadingDateSensor(EonNextMeterSensor):
+    """Date of latest meter reading"""
+
+    def __init__(self, coordinator, meter):
+        super().__init__(coordinator, meter, lambda: meter.latest_reading_date)
 
         self._attr_name = self.meter.get_serial() + " Reading Date"
         self._attr_device_class = SensorDeviceClass.DATE
         self._attr_icon = "mdi:calendar"
         self._attr_unique_id = self.meter.get_serial() + "__" + "reading_date"
-    
-
-    async def async_update(self) -> None:
-        self._attr_native_value = await self.meter.get_latest_reading_date()
 
 
 
-class LatestElectricKwhSensor(SensorEntity):
+class LatestElectricKwhSensor(EonNextMeterSensor):
     """Latest electricity meter reading"""
 
-    def __init__(self, meter):
-        self.meter = meter
+    def __init__(self, coordinator, meter):
+        super().__init__(coordinator, meter, lambda: meter.latest_reading)
 
         self._attr_name = self.meter.get_serial() + " Electricity"
         self._attr_device_class = SensorDeviceClass.ENERGY
@@ -70,18 +164,14 @@ class LatestElectricKwhSensor(SensorEntity):
         self._attr_state_class = "total"
         self._attr_icon = "mdi:meter-electric-outline"
         self._attr_unique_id = self.meter.get_serial() + "__" + "electricity_kwh"
-    
 
-    async def async_update(self) -> None:
-        self._attr_native_value = await self.meter.get_latest_reading()
 
 
-
-class LatestGasKwhSensor(SensorEntity):
+class LatestGasKwhSensor(EonNextMeterSensor):
     """Latest gas meter reading in kWh"""
 
-    def __init__(self, meter):
-        self.meter = meter
+    def __init__(self, coordinator, meter):
+        super().__init__(coordinator, meter, lambda: meter.latest_reading_kwh)
 
         self._attr_name = self.meter.get_serial() + " Gas kWh"
         self._attr_device_class = SensorDeviceClass.ENERGY
@@ -89,18 +179,14 @@ class LatestGasKwhSensor(SensorEntity):
         self._attr_state_class = "total"
         self._attr_icon = "mdi:meter-gas-outline"
         self._attr_unique_id = self.meter.get_serial() + "__" + "gas_kwh"
-    
-
-    async def async_update(self) -> None:
-        self._attr_native_value = await self.meter.get_latest_reading_kwh()
 
 
 
-class LatestGasCubicMetersSensor(SensorEntity):
+class LatestGasCubicMetersSensor(EonNextMeterSensor):
     """Latest gas meter reading in kWh"""
 
-    def __init__(self, meter):
-        self.meter = meter
+    def __init__(self, coordinator, meter):
+        super().__init__(coordinator, meter, lambda: meter.latest_reading)
 
         self._attr_name = self.meter.get_serial() + " Gas"
         self._attr_device_class = SensorDeviceClass.GAS
@@ -108,8 +194,106 @@ class LatestGasCubicMetersSensor(SensorEntity):
         self._attr_state_class = "total"
         self._attr_icon = "mdi:meter-gas-outline"
         self._attr_unique_id = self.meter.get_serial() + "__" + "gas_m3"
+
+
+
+class RegisterReadingSensor(EonNextMeterSensor):
+    """Latest reading of one register of a multi-rate meter"""
+
+    def __init__(self, coordinator, meter, register):
+        self.register = register
+        super().__init__(coordinator, meter, lambda: meter.latest_registers.get(register))
+
+        self._attr_name = self.meter.get_serial() + " " + register
+        if self.meter.get_type() == METER_TYPE_GAS:
+            self._attr_device_class = SensorDeviceClass.GAS
+            self._attr_native_unit_of_measurement = UnitOfVolume.CUBIC_METERS
+            self._attr_icon = "mdi:meter-gas-outline"
+        else:
+            self._attr_device_class = SensorDeviceClass.ENERGY
+            self._attr_native_unit_of_measurement = UnitOfEnergy.KILO_WATT_HOUR
+            self._attr_icon = "mdi:meter-electric-outline"
+        self._attr_state_class = "total"
+        self._attr_unique_id = self.meter.get_serial() + "__" + "register_" + re.sub(r"[^a-z0-9_]", "_", register.lower())
+
+
+
+class CostSensor(EonNextMeterSensor):
+    """Cost of all stored readings at the meter's tariffs, standing charges included"""
+
+    def __init__(self, coordinator, meter):
+        super().__init__(coordinator, meter, lambda: coordinator.costs.get(meter.meter_id))
+
+        self._attr_name = self.meter.get_serial() + " Cost"
+        self._attr_device_class = SensorDeviceClass.MONETARY
+        self._attr_native_unit_of_measurement = CURRENCY
+        self._attr_state_class = "total"
+        self._attr_icon = "mdi:currency-gbp"
+        self._attr_unique_id = self.meter.get_serial() + "__" + "cost"
+
+
+
+class LastRefreshDurationSensor(EonNextSensor):
+    """How long the last refresh of every meter took"""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_entity_registry_enabled_default = False
+
+    def __init__(self, coordinator, config_entry):
+        super().__init__(coordinator, self.__duration)
+
+        self._attr_name = "Eon Next Last Refresh Duration"
+        self._attr_device_class = SensorDeviceClass.DURATION
+        self._attr_native_unit_of_measurement = UnitOfTime.SECONDS
+        self._attr_state_class = "measurement"
+        self._attr_icon = "mdi:timer-outline"
+        self._attr_unique_id = config_entry.entry_id + "__" + "last_refresh_duration"
     
 
-    async def async_update(self) -> None:
-        self._attr_native_value = await self.meter.get_latest_reading()
+    def __duration(self):
+        if self.coordinator.last_refresh_duration == None:
+            return None
+        return round(self.coordinator.last_refresh_duration, 3)
+
+
+
+class ApiCallsPerHourSensor(EonNextSensor):
+    """Number of Eon Next API requests made in the last hour"""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_entity_registry_enabled_default = False
+
+    def __init__(self, coordinator, config_entry):
+        super().__init__(coordinator, coordinator.api.metrics.calls_last_hour)
+
+        self._attr_name = "Eon Next API Calls Per Hour"
+        self._attr_native_unit_of_measurement = "calls/h"
+        self._attr_state_class = "measurement"
+        self._attr_icon = "mdi:api"
+        self._attr_unique_id = config_entry.entry_id + "__" + "api_calls_per_hour"
+
+
+
+class ConsumptionTodaySensor(EonNextMeterSensor):
+    """Consumption so far today from half-hourly smart meter data"""
+
+    def __init__(self, coordinator, meter):
+        super().__init__(coordinator, meter, self.__today)
+
+        unit = (self.meter.consumption.unit or "").lower()
+        if "m3" in unit or "cubic" in unit:
+            self._attr_device_class = SensorDeviceClass.GAS
+            self._attr_native_unit_of_measurement = UnitOfVolume.CUBIC_METERS
+        else:
+            self._attr_device_class = SensorDeviceClass.ENERGY
+            self._attr_native_unit_of_measurement = UnitOfEnergy.KILO_WATT_HOUR
+
+        self._attr_name = self.meter.get_serial() + " Consumption Today"
+        self._attr_state_class = "total_increasing"
+        self._attr_icon = "mdi:chart-bar"
+        self._attr_unique_id = self.meter.get_serial() + "__" + "consumption_today"
+    
 
+    def __today(self):
+        today = dt_util.now(LOCAL_TIMEZONE).date()
+        return round(self.meter.consumption.daily.get(today, 0.0), 3)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import datetime
+import logging
+import re
+
+from homeassistant.components.recorder import get_instance
+from homeassistant.components.recorder.models import StatisticData, StatisticMetaData
+from homeassistant.components.recorder.statistics import async_add_external_statistics, get_last_statistics
+from homeassistant.const import UnitOfEnergy, UnitOfVolume
+
+from .const import CURRENCY, DOMAIN
+from .eonnext import METER_TYPE_GAS, METER_TYPE_ELECTRIC
+
+_LOGGER = logging.getLogger(__name__)
+
+STATISTICS_BATCH_SIZE = 500
+
+
+def _statistic_id(meter, suffix: str) -> str:
+    object_id = re.sub(r"[^a-z0-9_]", "_", meter.get_serial().lower()) + "_" + suffix
+    return DOMAIN + ":" + object_id
+
+
+def _unconverted(value: float, day: datetime.date) -> float:
+    return float(value)
+
+
+def _meter_series(meter) -> list:
+    """(statistic id, name, unit, conversion) for each series a meter feeds.
+
+    Conversions take a value and the date it applies to."""
+    if meter.get_type() == METER_TYPE_ELECTRIC:
+        return [
+            (_statistic_id(meter, "electricity_kwh"), meter.get_serial() + " Electricity", UnitOfEnergy.KILO_WATT_HOUR, _unconverted)
+        ]
+
+    if meter.get_type() == METER_TYPE_GAS:
+        return [
+            (_statistic_id(meter, "gas_m3"), meter.get_serial() + " Gas", UnitOfVolume.CUBIC_METERS, _unconverted),
+            (_statistic_id(meter, "gas_kwh"), meter.get_serial() + " Gas kWh", UnitOfEnergy.KILO_WATT_HOUR, meter.api.calorific_values.m3_to_kwh)
+        ]
+
+    return []
+
+
+def _to_datetime(value) -> datetime.datetime:
+    # Older recorders return datetimes, newer ones timestamps
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+
+
+async def _async_last_statistic(hass, statistic_id: str) -> tuple:
+    """(start, state, sum) of the newest statistic, or Nones and a zero sum."""
+    last = await get_instance(hass).async_add_executor_job(
+        get_last_statistics, hass, 1, statistic_id, True, {"state", "sum"}
+    )
+
+    if statistic_id in last and len(last[statistic_id]) > 0:
+        return _to_datetime(last[statistic_id][0]['start']), last[statistic_id][0]['state'], last[statistic_id][0]['sum'] or 0.0
+    return None, None, 0.0
+
+
+async def async_import_meter_statistics(hass, reading_store, meter) -> int:
+    """Import a meter's readings newer than its last statistic into the recorder."""
+    imported = 0
+
+    for statistic_id, name, unit, convert in _meter_series(meter):
+        last_start, last_state, last_sum = await _async_last_statistic(hass, statistic_id)
+
+        # Store times are naive UTC. The reading behind the last statistic is
+        # fetched again, since sums grow by the converted difference from it.
+        after = None if last_start == None else last_start.astimezone(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(seconds=1)
+        totals = await hass.async_add_executor_job(reading_store.totals, meter.meter_id, after)
+
+        metadata = StatisticMetaData(
+            has_mean=False,
+            has_sum=True,
+            name=name,
+            source=DOMAIN,
+            statistic_id=statistic_id,
+            unit_of_measurement=unit
+        )
+
+        statistics = []
+        last_total = None
+        for read_at, total in totals:
+            read_time = datetime.datetime.fromisoformat(read_at)
+            start = read_time.replace(minute=0, second=0, tzinfo=datetime.timezone.utc)
+
+            # Statistics are hourly, so only the first reading of an hour counts
+            if last_start != None and start <= last_start:
+                if start == last_start and last_total == None:
+                    last_total = total
+                continue
+
+            state = convert(total, read_time.date())
+            if last_total != None:
+                last_sum = last_sum + convert(total - last_total, read_time.date())
+            elif last_state != None:
+                last_sum = last_sum + state - last_state
+
+            statistics.append(StatisticData(start=start, state=state, sum=last_sum))
+            last_start = start
+            last_state = state
+            last_total = total
+
+            if len(statistics) >= STATISTICS_BATCH_SIZE:
+                async_add_external_statistics(hass, metadata, statistics)
+                imported += len(statistics)
+                statistics = []
+
+        if len(statistics) > 0:
+            async_add_external_statistics(hass, metadata, statistics)
+            imported += len(statistics)
+
+    return imported
+
+
+async def async_import_cost_statistics(hass, meter, costs: list) -> int:
+    """Import daily costs, as (day, kWh, pence) from meter.daily_costs(), newer than the last statistic."""
+    statistic_id = _statistic_id(meter, "cost")
+    last_start, last_state, last_sum = await _async_last_statistic(hass, statistic_id)
+
+    metadata = StatisticMetaData(
+        has_mean=False,
+        has_sum=True,
+        name=meter.get_serial() + " Cost",
+        source=DOMAIN,
+        statistic_id=statistic_id,
+        unit_of_measurement=CURRENCY
+    )
+
+    imported = 0
+    statistics = []
+    for day, kwh, cost in costs:
+        start = datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc)
+        if cost == None or (last_start != None and start <= last_start):
+            continue
+
+        state = round(cost / 100, 2)
+        last_sum = last_sum + state
+        statistics.append(StatisticData(start=start, state=state, sum=last_sum))
+
+        if len(statistics) >= STATISTICS_BATCH_SIZE:
+            async_add_external_statistics(hass, metadata, statistics)
+            imported += len(statistics)
+            statistics = []
+
+    if len(statistics) > 0:
+        async_add_external_statistics(hass, metadata, statistics)
+        imported += len(statistics)
+
+    return imported
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import bisect
+import datetime
+
+DEFAULT_TARIFF_TTL = datetime.timedelta(hours=12)
+
+# Kraken does not publish calorific values, so gas is converted with this
+# unless better figures are supplied
+DEFAULT_CALORIFIC_VALUE = 38.0
+VOLUME_CORRECTION = 1.02264
+MJ_PER_KWH = 3.6
+
+
+def _parse_date(value) -> datetime.date:
+    if value == None:
+        return None
+    return datetime.datetime.fromisoformat(value).date()
+
+
+class Agreement:
+    """One tariff agreement of a supply point. Rates are in pence including
+    VAT, per kWh for the unit rate and per day for the standing charge.
+    `valid_to` is exclusive, None for an open ended agreement. Multi-rate
+    tariffs have no single unit rate, so theirs is None."""
+
+    def __init__(self, supply_point_id: str, valid_from: datetime.date, valid_to: datetime.date, unit_rate: float = None, standing_charge: float = None):
+        self.supply_point_id = supply_point_id
+        self.valid_from = valid_from
+        self.valid_to = valid_to
+        self.unit_rate = unit_rate
+        self.standing_charge = standing_charge
+
+
+    def covers(self, day: datetime.date) -> bool:
+        if self.valid_from != None and day < self.valid_from:
+            return False
+        return self.valid_to == None or day < self.valid_to
+
+
+    @classmethod
+    def from_api(cls, supply_point_id: str, agreement: dict):
+        tariff = agreement.get("tariff") or {}
+        return cls(
+            supply_point_id,
+            _parse_date(agreement.get("validFrom")),
+            _parse_date(agreement.get("validTo")),
+            float(tariff['unitRate']) if tariff.get("unitRate") != None else None,
+            float(tariff['standingCharge']) if tariff.get("standingCharge") != None else None
+        )
+
+
+class RateTable:
+    """Unit rate and standing charge for each day, worked out once from a
+    supply point's agreements so costing a history needs no lookups of the
+    agreements themselves."""
+
+    def __init__(self, agreements: list):
+        self.agreements = sorted(agreements, key=lambda agreement: agreement.valid_from or datetime.date.min)
+        self.days = {}
+
+
+    def build(self, start: datetime.date, end: datetime.date):
+        # Fills in every day from start up to and including end
+        day = start
+        while day <= end:
+            if day not in self.days:
+                self.days[day] = self.__find(day)
+            day = day + datetime.timedelta(days=1)
+
+
+    def __find(self, day: datetime.date) -> tuple:
+        # The latest agreement to start wins where they overlap
+        for agreement in reversed(self.agreements):
+            if agreement.covers(day):
+                return agreement.unit_rate, agreement.standing_charge
+        return None, None
+
+
+    def has_unit_rate(self) -> bool:
+        # Whether any of the agreements can be costed
+        return any(agreement.unit_rate != None for agreement in self.agreements)
+
+
+    def rates(self, day: datetime.date) -> tuple:
+        # (unit rate, standing charge), either None where there is no tariff
+        if day not in self.days:
+            self.days[day] = self.__find(day)
+        return self.days[day]
+
+
+class CalorificValues:
+    """Calorific values of gas in MJ/m³ by the date they apply from, falling
+    back on a default before the first of them."""
+
+    def __init__(self, default: float = DEFAULT_CALORIFIC_VALUE, values: dict = None):
+        self.default = default
+        self.set_values(values or {})
+
+
+    def set_values(self, values: dict):
+        self.dates = sorted(values)
+        self.values = [values[day] for day in self.dates]
+
+
+    def lookup(self, day: datetime.date = None) -> float:
+        if day == None or len(self.dates) == 0:
+            return self.default
+        index = bisect.bisect_right(self.dates, day) - 1
+        return self.values[index] if index >= 0 else self.default
+
+
+    def m3_to_kwh(self, m3: float, day: datetime.date = None) -> float:
+        return m3 * VOLUME_CORRECTION * self.lookup(day) / MJ_PER_KWH
+
+
+def daily_costs(deltas: list, rate_table: RateTable, calorific_values: CalorificValues = None) -> list:
+    """Cost of each period of consumption, from (YYYY-MM-DD, delta) pairs as
+    given by ReadingStore.daily_deltas().
+
+    Deltas are in kWh, or in m³ when calorific_values is given, and each
+    covers the days since the previous one. Returns (day, kWh, cost in pence)
+    for each, with the cost None where a day in the period has no tariff. The
+    unit rate is that of the reading day, and the standing charge is added
+    for every day covered."""
+    if len(deltas) == 0:
+        return []
+
+    days = [datetime.date.fromisoformat(day) for day, delta in deltas]
+    rate_table.build(days[0], days[-1])
+
+    costs = []
+    previous = None
+    for day, (period, delta) in zip(days, deltas):
+        kwh = delta if calorific_values == None else calorific_values.m3_to_kwh(delta, day)
+        unit_rate, standing_charge = rate_table.rates(day)
+
+        cost = None
+        if unit_rate != None and standing_charge != None:
+            cost = kwh * unit_rate
+
+            covered = 1 if previous == None else (day - previous).days
+            for offset in range(covered):
+                day_standing_charge = rate_table.rates(day - datetime.timedelta(days=offset))[1]
+                if day_standing_charge == None:
+                    cost = None
+                    break
+                cost = cost + day_standing_charge
+
+        costs.append((day, kwh, cost))
+        previous = day
+
+    return costs
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import array
+import datetime
+import math
+import zoneinfo
+
+INTERVAL_SECONDS = 30 * 60
+HOUR_SECONDS = 60 * 60
+
+LOCAL_TIMEZONE = zoneinfo.ZoneInfo("Europe/London")
+
+MISSING = float("nan")
+
+
+def _timestamp(value) -> int:
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo == None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return int(value.timestamp())
+    return int(value)
+
+
+def _sum(values) -> float:
+    return math.fsum(value for value in values if value == value)
+
+
+class IntervalSeries:
+    """Half-hourly consumption held in a flat array of doubles.
+
+    Slot n covers the half hour starting `origin + n * 30 minutes`, and
+    missing slots hold NaN, so a year of data takes about 140 KiB. Hourly,
+    daily and monthly totals are kept up to date as slots are set, days and
+    months being those of UK local time."""
+
+    def __init__(self, unit: str = None):
+        self.unit = unit
+        self.origin = None
+        self.values = array.array("d")
+
+        self.hourly = {}
+        self.daily = {}
+        self.monthly = {}
+
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+    def start(self) -> datetime.datetime:
+        if self.origin == None:
+            return None
+        return datetime.datetime.fromtimestamp(self.origin, datetime.timezone.utc)
+
+
+    def end(self) -> datetime.datetime:
+        # End of the last slot which has a value
+        for index in range(len(self.values) - 1, -1, -1):
+            if self.values[index] == self.values[index]:
+                return datetime.datetime.fromtimestamp(self.origin + (index + 1) * INTERVAL_SECONDS, datetime.timezone.utc)
+        return None
+
+
+    def __slot(self, timestamp: int) -> int:
+        timestamp = timestamp - timestamp % INTERVAL_SECONDS
+
+        if self.origin == None:
+            self.origin = timestamp
+
+        if timestamp < self.origin:
+            # Older than anything held so far, so the array grows at the front
+            missing = (self.origin - timestamp) // INTERVAL_SECONDS
+            self.values = array.array("d", [MISSING] * missing) + self.values
+            self.origin = timestamp
+
+        index = (timestamp - self.origin) // INTERVAL_SECONDS
+        if index >= len(self.values):
+            self.values.extend([MISSING] * (index + 1 - len(self.values)))
+        return index
+
+
+    def __rollup_keys(self, timestamp: int) -> tuple:
+        local = datetime.datetime.fromtimestamp(timestamp, LOCAL_TIMEZONE)
+        return timestamp - timestamp % HOUR_SECONDS, local.date(), (local.year, local.month)
+
+
+    def set(self, start, value: float):
+        # Sets one interval, replacing any value it already had, and adjusts
+        # the rollups by the difference
+        timestamp = _timestamp(start)
+        index = self.__slot(timestamp)
+
+        previous = self.values[index]
+        self.values[index] = value
+
+        # A slot which had no value gets its rollups even when it adds
+        # nothing, as a zero half hour still counts as data
+        difference = value - (previous if previous == previous else 0.0)
+        if difference == 0 and previous == previous:
+            return
+
+        hour, day, month = self.__rollup_keys(self.origin + index * INTERVAL_SECONDS)
+        self.hourly[hour] = self.hourly.get(hour, 0.0) + difference
+        self.daily[day] = self.daily.get(day, 0.0) + difference
+        self.monthly[month] = self.monthly.get(month, 0.0) + difference
+
+
+    def extend(self, intervals):
+        # (start, value) pairs, in any order
+        for start, value in intervals:
+            self.set(start, value)
+
+
+    def total(self, start=None, end=None) -> float:
+        if self.origin == None:
+            return 0.0
+
+        first = 0 if start == None else max((_timestamp(start) - self.origin) // INTERVAL_SECONDS, 0)
+        last = len(self.values) if end == None else max((_timestamp(end) - self.origin) // INTERVAL_SECONDS, 0)
+        return _sum(self.values[first:last])
+
+
+    def rebuild_rollups(self):
+        # Recomputes every rollup from the array, a day at a time
+        self.hourly = {}
+        self.daily = {}
+        self.monthly = {}
+        if self.origin == None:
+            return
+
+        first_hour = self.origin - self.origin % HOUR_SECONDS
+        for hour in range(first_hour, self.origin + len(self.values) * INTERVAL_SECONDS, HOUR_SECONDS):
+            # The first hour may start before the origin
+            first = max((hour - self.origin) // INTERVAL_SECONDS, 0)
+            last = (hour + HOUR_SECONDS - self.origin) // INTERVAL_SECONDS
+            chunk = self.values[first:last]
+            if any(value == value for value in chunk):
+                self.hourly[hour] = _sum(chunk)
+
+        day = datetime.datetime.fromtimestamp(self.origin, LOCAL_TIMEZONE).date()
+        last_day = datetime.datetime.fromtimestamp(self.origin + len(self.values) * INTERVAL_SECONDS, LOCAL_TIMEZONE).date()
+        while day <= last_day:
+            midnight = datetime.datetime.combine(day, datetime.time(), LOCAL_TIMEZONE)
+            next_day = day + datetime.timedelta(days=1)
+            next_midnight = datetime.datetime.combine(next_day, datetime.time(), LOCAL_TIMEZONE)
+
+            first = max((_timestamp(midnight) - self.origin) // INTERVAL_SECONDS, 0)
+            last = max((_timestamp(next_midnight) - self.origin) // INTERVAL_SECONDS, 0)
+            chunk = self.values[first:last]
+            if any(value == value for value in chunk):
+                self.daily[day] = _sum(chunk)
+                month = (day.year, day.month)
+                self.monthly[month] = self.monthly.get(month, 0.0) + self.daily[day]
+            day = next_day
+
+
+    def trim(self, before):
+        # Drops every slot starting before `before`, keeping memory bounded
+        if self.origin == None:
+            return
+
+        drop = (_timestamp(before) - self.origin) // INTERVAL_SECONDS
+        if drop <= 0:
+            return
+
+        # Only the rollups of the dropped slots change: those wholly before
+        # the new origin go, and any the cut falls inside lose the dropped part
+        drop = min(drop, len(self.values))
+        touched = set()
+        for index in range(drop):
+            value = self.values[index]
+            if value == value:
+                keys = self.__rollup_keys(self.origin + index * INTERVAL_SECONDS)
+                touched.add(keys)
+                hour, day, month = keys
+                self.hourly[hour] = self.hourly.get(hour, 0.0) - value
+                self.daily[day] = self.daily.get(day, 0.0) - value
+                self.monthly[month] = self.monthly.get(month, 0.0) - value
+
+        del self.values[:drop]
+        self.origin = self.origin + drop * INTERVAL_SECONDS
+        if len(self.values) == 0:
+            self.origin = None
+            self.hourly = {}
+            self.daily = {}
+            self.monthly = {}
+            return
+
+        first_hour, first_day, first_month = self.__rollup_keys(self.origin)
+        for hour, day, month in touched:
+            if hour < first_hour:
+                self.hourly.pop(hour, None)
+            if day < first_day:
+                self.daily.pop(day, None)
+            if month < first_month:
+                self.monthly.pop(month, None)
+
+        # The rollups the cut fell inside go too if nothing is left in them,
+        # each found from the one below it so no more than a day is scanned
+        if first_hour in self.hourly and any(value == value for value in self.values[:(first_hour + HOUR_SECONDS - self.origin) // INTERVAL_SECONDS]) == False:
+            del self.hourly[first_hour]
+
+        next_midnight = _timestamp(datetime.datetime.combine(first_day + datetime.timedelta(days=1), datetime.time(), LOCAL_TIMEZONE))
+        if first_day in self.daily and any(hour in self.hourly for hour in range(first_hour, next_midnight, HOUR_SECONDS)) == False:
+            del self.daily[first_day]
+
+        if first_month in self.monthly:
+            day = first_day
+            while (day.year, day.month) == first_month and day not in self.daily:
+                day = day + datetime.timedelta(days=1)
+            if (day.year, day.month) != first_month:
+                del self.monthly[first_month]
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+import aiohttp
+import asyncio
+import email.utils
+import importlib.util
+import json
+import logging
+import random
+import time
+
+from .queries import PersistedQuery
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_REQUEST_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 10
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 300
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# aiohttp only decodes brotli when one of these is installed
+ACCEPT_ENCODING = "gzip, deflate"
+if importlib.util.find_spec("brotli") != None or importlib.util.find_spec("brotlicffi") != None:
+    ACCEPT_ENCODING = ACCEPT_ENCODING + ", br"
+
+PERSISTED_QUERY_NOT_FOUND = "PersistedQueryNotFound"
+PERSISTED_QUERY_NOT_SUPPORTED = "PersistedQueryNotSupported"
+
+# Kraken error codes of rejected credentials and invalid or expired tokens
+AUTHENTICATION_ERROR_CODES = ("KT-CT-1111", "KT-CT-1112", "KT-CT-1124", "KT-CT-1134", "KT-CT-1135", "KT-CT-1138", "KT-CT-1139")
+
+
+class JsonBackend:
+    """Encodes request bodies to bytes and decodes response bodies."""
+
+    def __init__(self, name: str, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+def _json_dumps(value) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+JSON_BACKENDS = {"json": JsonBackend("json", json.loads, _json_dumps)}
+if orjson != None:
+    JSON_BACKENDS['orjson'] = JsonBackend("orjson", orjson.loads, orjson.dumps)
+
+# orjson, which Home Assistant already ships, when it is installed
+DEFAULT_JSON_BACKEND = "orjson" if "orjson" in JSON_BACKENDS else "json"
+
+
+def get_json_backend(name: str = None) -> JsonBackend:
+    if name == None:
+        name = DEFAULT_JSON_BACKEND
+    if name not in JSON_BACKENDS:
+        raise ValueError("Unknown JSON backend " + str(name))
+    return JSON_BACKENDS[name]
+
+
+class EonNextApiError(Exception):
+    """Base class for errors talking to the Eon Next API."""
+
+
+class EonNextTransportError(EonNextApiError):
+    """The API could not be reached or kept failing after retries."""
+
+
+class EonNextUnavailable(EonNextApiError):
+    """Requests are being refused because the API has been failing."""
+
+
+class EonNextAuthenticationError(EonNextApiError):
+    """The API rejected the credentials or the token, or there are none."""
+
+
+class EonNextGraphQLError(EonNextApiError):
+    """The API answered, but with GraphQL errors and no data."""
+
+    def __init__(self, operation: str, errors: list):
+        messages = [str(error.get("message", error)) if isinstance(error, dict) else str(error) for error in errors]
+        super().__init__(operation + ": " + "; ".join(messages))
+        self.operation = operation
+        self.errors = errors
+        self.codes = [(error.get("extensions") or {}).get("errorCode") for error in errors if isinstance(error, dict)]
+
+
+class EonNextGraphQLAuthenticationError(EonNextGraphQLError, EonNextAuthenticationError):
+    """The API answered with GraphQL errors rejecting the credentials or the token."""
+
+
+class EonNextDecodeError(EonNextApiError):
+    """The API answered with data which is not of the expected shape."""
+
+    def __init__(self, operation: str, message: str):
+        super().__init__(operation + ": " + message)
+        self.operation = operation
+
+
+def graphql_error(operation: str, errors: list) -> EonNextGraphQLError:
+    # The most specific error for the GraphQL errors of a response
+    error = EonNextGraphQLError(operation, errors)
+    if any(code in AUTHENTICATION_ERROR_CODES for code in error.codes):
+        return EonNextGraphQLAuthenticationError(operation, errors)
+    return error
+
+
+class _RetryableStatus(Exception):
+
+    def __init__(self, status: int, retry_after: float = None):
+        super().__init__("HTTP " + str(status))
+        self.status = status
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, in bursts of up to
+    `capacity`. Waiters are served in the order they arrive."""
+
+    def __init__(self, rate: float = DEFAULT_RATE, capacity: int = DEFAULT_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = float(capacity)
+        self.__updated = time.monotonic()
+        self.__lock = None
+    
+
+    async def acquire(self):
+        if self.__lock == None:
+            self.__lock = asyncio.Lock()
+
+        async with self.__lock:
+            while True:
+                now = time.monotonic()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+                self.__updated = now
+
+                if self.__tokens >= 1:
+                    self.__tokens = self.__tokens - 1
+                    return
+
+                await asyncio.sleep((1 - self.__tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures, refusing requests
+    for `reset_timeout` seconds. After that a single trial request is let
+    through, which closes it again if it succeeds."""
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.__trial_running = False
+    
+
+    def is_open(self) -> bool:
+        # Whether requests are being refused. Once reset_timeout has passed
+        # it is no longer, until the trial request has been sent.
+        if self.opened_at == None:
+            return False
+        return self.__trial_running == True or time.monotonic() - self.opened_at < self.reset_timeout
+    
+
+    def allow(self) -> bool:
+        # True for every request while closed, and for the one trial request
+        # once reset_timeout has passed, which must then be ended with
+        # record_success(), record_failure() or abandon_trial()
+        if self.opened_at == None:
+            return True
+
+        if self.__trial_running == False and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.__trial_running = True
+            return True
+
+        return False
+    
+
+    def abandon_trial(self):
+        # The trial request ended without an outcome, such as by being
+        # cancelled, so the next request becomes the trial
+        self.__trial_running = False
+    
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.__trial_running = False
+    
+
+    def record_failure(self):
+        self.failures = self.failures + 1
+        if self.__trial_running == True or self.failures >= self.failure_threshold:
+            if self.opened_at == None:
+                _LOGGER.warning("Eon Next API is failing, pausing requests for %s seconds", self.reset_timeout)
+            self.opened_at = time.monotonic()
+            self.__trial_running = False
+
+
+# Shared by every client in the process, whichever login or config entry it
+# belongs to, since the limits and health are those of the one API
+SHARED_RATE_LIMITER = TokenBucket()
+SHARED_CIRCUIT_BREAKER = CircuitBreaker()
+
+# Whether each API URL takes Automatic Persisted Queries, shared in the same
+# way so that only the first client has to find out
+PERSISTED_QUERY_SUPPORT = {}
+
+
+class GraphQLTransport:
+    """Posts GraphQL requests with a timeout, rate limiting, retries with
+    jittered exponential backoff and a circuit breaker."""
+
+    def __init__(self, url: str, request_timeout: float = DEFAULT_REQUEST_TIMEOUT, max_retries: int = DEFAULT_MAX_RETRIES, backoff_base: float = DEFAULT_BACKOFF_BASE, backoff_max: float = DEFAULT_BACKOFF_MAX, rate_limiter: TokenBucket = None, circuit_breaker: CircuitBreaker = None, metrics = None, json_backend: str = None):
+        self.url = url
+        self.metrics = metrics
+        self.json = get_json_backend(json_backend)
+        self.timeout = aiohttp.ClientTimeout(total=request_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = rate_limiter if rate_limiter != None else SHARED_RATE_LIMITER
+        self.circuit_breaker = circuit_breaker if circuit_breaker != None else SHARED_CIRCUIT_BREAKER
+    
+
+    @property
+    def persisted_queries(self) -> bool:
+        # Whether the server takes Automatic Persisted Queries. None until a
+        # hash-only request has been answered either way.
+        return PERSISTED_QUERY_SUPPORT.get(self.url)
+    
+
+    @persisted_queries.setter
+    def persisted_queries(self, supported: bool):
+        PERSISTED_QUERY_SUPPORT[self.url] = supported
+    
+
+    def _retry_after(self, header: str) -> float:
+        if header == None:
+            return None
+        try:
+            return max(float(header), 0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(header).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+    
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: anywhere between nothing and the exponential delay
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+    
+
+    async def __post_once(self, session: aiohttp.ClientSession, payload: dict, headers: dict) -> dict:
+        body = self.json.dumps(payload)
+        received_size = 0
+        decode_time = 0.0
+        started = time.monotonic()
+
+        try:
+            async with session.post(self.url, data=body, headers={**headers, "Content-Type": "application/json", "Accept-Encoding": ACCEPT_ENCODING}, timeout=self.timeout) as response:
+                if response.status in RETRY_STATUSES:
+                    raise _RetryableStatus(response.status, self._retry_after(response.headers.get("Retry-After")))
+
+                received = await response.read()
+                # Bytes on the wire, before any decompression
+                received_size = response.content_length if response.content_length != None else len(received)
+                decode_started = time.perf_counter()
+                try:
+                    result = self.json.loads(received)
+                except ValueError as err:
+                    raise EonNextTransportError("Unexpected response from the API, HTTP " + str(response.status)) from err
+                decode_time = time.perf_counter() - decode_started
+        except Exception as err:
+            self.__record(payload, started, body, received_size, decode_time, str(err) or type(err).__name__)
+            raise
+
+        self.__record(payload, started, body, received_size, decode_time, None)
+        return result
+    
+
+    def __record(self, payload: dict, started: float, body: bytes, received_size: int, decode_time: float, error: str):
+        if self.metrics != None:
+            self.metrics.record_request(str(payload.get("operationName")), time.monotonic() - started, len(body), received_size, error, decode_time)
+    
+
+    async def post(self, session: aiohttp.ClientSession, payload: dict, headers: dict) -> dict:
+        # Any request let through while the breaker is open is its trial
+        trial = self.circuit_breaker.opened_at != None
+        if self.circuit_breaker.allow() == False:
+            raise EonNextUnavailable("Eon Next API is unavailable, requests are paused")
+
+        try:
+            return await self.__post_with_retries(session, payload, headers)
+        except BaseException:
+            if trial == True and self.circuit_breaker.opened_at != None:
+                self.circuit_breaker.abandon_trial()
+            raise
+    
+
+    async def __post_with_retries(self, session: aiohttp.ClientSession, payload: dict, headers: dict) -> dict:
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+
+            try:
+                result = await self.__post_once(session, payload, headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError, _RetryableStatus) as err:
+                last_error = err
+                if attempt == self.max_retries:
+                    break
+
+                delay = self._backoff(attempt)
+                if isinstance(err, _RetryableStatus) and err.retry_after != None:
+                    delay = min(err.retry_after, self.backoff_max)
+
+                _LOGGER.debug("%s failed (%s), retrying in %.1f seconds", payload.get("operationName"), err, delay)
+                await asyncio.sleep(delay)
+                continue
+            except EonNextTransportError:
+                self.circuit_breaker.record_failure()
+                raise
+
+            self.circuit_breaker.record_success()
+            return result
+
+        self.circuit_breaker.record_failure()
+        raise EonNextTransportError(str(payload.get("operationName")) + " failed: " + str(last_error)) from last_error
+    
+
+    def __persisted_query_error(self, result: dict) -> str:
+        # The error code of a hash-only request the server could not run, or
+        # None if it was answered
+        if isinstance(result, dict) == False or result.get("data") != None:
+            return None
+
+        for error in result.get("errors") or []:
+            if isinstance(error, dict) == False:
+                continue
+            code = (error.get("extensions") or {}).get("code") or ""
+            message = str(error.get("message", ""))
+            if PERSISTED_QUERY_NOT_SUPPORTED in message or code == "PERSISTED_QUERY_NOT_SUPPORTED":
+                return PERSISTED_QUERY_NOT_SUPPORTED
+            if PERSISTED_QUERY_NOT_FOUND in message or code == "PERSISTED_QUERY_NOT_FOUND":
+                return PERSISTED_QUERY_NOT_FOUND
+
+        if len(result.get("errors") or []) > 0 and self.persisted_queries == None:
+            # Servers without persisted queries tend to just complain that
+            # there is no query
+            return PERSISTED_QUERY_NOT_SUPPORTED
+        return None
+    
+
+    async def post_query(self, session: aiohttp.ClientSession, query: PersistedQuery, variables: dict, headers: dict) -> dict:
+        # Sends just the query's hash, then the full document if the server
+        # does not have it yet. Once a server turns out not to support
+        # persisted queries only full documents are sent.
+        if self.persisted_queries == False:
+            return await self.post(session, query.payload(variables, persisted=False), headers)
+
+        result = await self.post(session, query.payload(variables, include_document=False), headers)
+        missed = self.__persisted_query_error(result)
+        if missed == None:
+            self.persisted_queries = True
+            return result
+
+        result = await self.post(session, query.payload(variables), headers)
+
+        if missed == PERSISTED_QUERY_NOT_SUPPORTED and self.persisted_queries == None:
+            if isinstance(result, dict) and result.get("data") != None:
+                _LOGGER.debug("Eon Next API does not support persisted queries, sending full queries")
+                self.persisted_queries = False
+        elif missed == PERSISTED_QUERY_NOT_FOUND:
+            self.persisted_queries = True
+
+        return result
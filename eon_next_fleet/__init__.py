@@ -0,0 +1,4 @@
+"""Harvest Eon Next meter readings for many logins without Home Assistant.
+
+Run from the repository root with `python -m eon_next_fleet --help`.
+"""
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Poll Eon Next meter readings for a list of logins.
+
+Logins are read from a JSON Lines file of {"email": ..., "password": ...}
+objects and shared out between worker processes, each with its own event
+loop. Run from the repository root:
+
+    python -m eon_next_fleet logins.jsonl --workers 4 --rate 20 --interval 900
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+from eon_next_library import load_library
+from .worker import OUTPUT_JSONL, OUTPUT_STORE, run_worker
+
+eonnext = load_library("eonnext")
+transport = load_library("transport")
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def read_logins(path: str) -> list:
+    logins = []
+    with open(path) as file:
+        for number, line in enumerate(file, 1):
+            if line.strip() == "":
+                continue
+            login = json.loads(line)
+            if "email" not in login or "password" not in login:
+                raise ValueError("Line " + str(number) + " of " + path + " needs an email and a password")
+            logins.append(login)
+    return logins
+
+
+def shard(logins: list, workers: int) -> list:
+    # By a hash of the email, so a login stays with the same worker across
+    # restarts as long as the number of workers does not change
+    shards = [[] for index in range(workers)]
+    for login in logins:
+        digest = hashlib.sha256(login['email'].lower().encode()).digest()
+        shards[int.from_bytes(digest[:8], "big") % workers].append(login)
+    return shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Poll Eon Next meter readings for many logins")
+    parser.add_argument("logins", help="JSON Lines file of {\"email\": ..., \"password\": ...}")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--rate", type=float, default=transport.DEFAULT_RATE, help="requests per second across all workers")
+    parser.add_argument("--burst", type=int, default=transport.DEFAULT_BURST, help="request burst across all workers")
+    parser.add_argument("--concurrency", type=int, default=8, help="logins polled at once by each worker")
+    parser.add_argument("--meter-concurrency", type=int, default=eonnext.DEFAULT_MAX_CONCURRENCY, help="requests at once for each login")
+    parser.add_argument("--connections", type=int, default=20, help="HTTP connections per worker")
+    parser.add_argument("--page-size", type=int, default=eonnext.DEFAULT_HISTORY_PAGE_SIZE)
+    parser.add_argument("--interval", type=float, default=0, help="seconds between polls, or 0 to poll once and exit")
+    parser.add_argument("--output", choices=(OUTPUT_JSONL, OUTPUT_STORE), default=OUTPUT_JSONL, help="write JSON Lines per worker, or into a SQLite reading store")
+    parser.add_argument("--output-dir", default="fleet-output", help="folder for JSON Lines output")
+    parser.add_argument("--store", default="eon_next.db", help="SQLite reading store for --output store")
+    parser.add_argument("--state-dir", default="fleet-state", help="folder for checkpoints")
+    parser.add_argument("--api-url", default=eonnext.API_URL)
+    parser.add_argument("--verbose", action="store_true")
+    arguments = parser.parse_args()
+
+    log_level = logging.DEBUG if arguments.verbose else logging.INFO
+    logging.basicConfig(level=log_level, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+
+    logins = read_logins(arguments.logins)
+    workers = max(min(arguments.workers, len(logins)), 1)
+
+    # Each worker limits itself to its share of the budget, so together
+    # they stay within it without having to coordinate
+    options = {
+        "rate": arguments.rate / workers,
+        "burst": arguments.burst // workers,
+        "concurrency": arguments.concurrency,
+        "meter_concurrency": arguments.meter_concurrency,
+        "connections": arguments.connections,
+        "page_size": arguments.page_size,
+        "interval": arguments.interval,
+        "output": arguments.output,
+        "output_dir": arguments.output_dir,
+        "store": arguments.store,
+        "state_dir": arguments.state_dir,
+        "api_url": arguments.api_url,
+        "log_level": log_level
+    }
+
+    _LOGGER.info("Polling %d logins with %d workers", len(logins), workers)
+
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index, logins_shard in enumerate(shard(logins, workers)):
+        process = context.Process(target=run_worker, args=(index, logins_shard, options), name="worker-" + str(index))
+        process.start()
+        processes.append(process)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Workers get the interrupt too and stop after closing their output
+        for process in processes:
+            process.join()
+
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if len(failed) > 0:
+        _LOGGER.error("Workers failed: %s", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+
+import aiohttp
+
+from eon_next_library import load_library
+
+eonnext = load_library("eonnext")
+export = load_library("export")
+reading_store = load_library("reading_store")
+transport = load_library("transport")
+
+_LOGGER = logging.getLogger(__name__)
+
+OUTPUT_JSONL = "jsonl"
+OUTPUT_STORE = "store"
+
+# The checkpoint holds every login of the shard, so it is written at most
+# this often while polling, and at the end of every cycle
+CHECKPOINT_INTERVAL = 10
+
+
+class Checkpoint:
+    """What a worker needs to carry on after a restart, by login: the
+    client's exported state (refresh token, meters and schedules) and the
+    newest reading already emitted for each meter."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.logins = {}
+
+
+    def load(self, emails: set):
+        # Every worker's file is read, since logins move between workers when
+        # their number changes. The newest state of each login wins.
+        self.logins = {}
+        for path in glob.glob(os.path.join(os.path.dirname(self.path), "worker-*.json")):
+            try:
+                with open(path) as file:
+                    logins = json.load(file)
+            except (OSError, ValueError) as err:
+                _LOGGER.warning("Unable to read checkpoint %s: %s", path, err)
+                continue
+
+            for email, state in logins.items():
+                if email in emails and state.get("saved", 0) >= self.logins.get(email, {}).get("saved", 0):
+                    self.logins[email] = state
+
+
+    def write(self, text: str):
+        export.write_file_atomically(self.path, text)
+
+
+class FleetWorker:
+    """Polls a shard of logins from one process and one event loop.
+
+    All of its clients share one connection pool and one rate limiter, which
+    gets its share of the fleet's rate budget."""
+
+    def __init__(self, index: int, logins: list, options: dict):
+        self.index = index
+        self.logins = logins
+        self.options = options
+
+        self.rate_limiter = transport.TokenBucket(options['rate'], max(options['burst'], 1))
+        self.circuit_breaker = transport.CircuitBreaker()
+        self.checkpoint = Checkpoint(os.path.join(options['state_dir'], "worker-%d.json" % index))
+        self.clients = {}
+        self.checkpoint_lock = asyncio.Lock()
+        self.checkpoint_saved = time.monotonic()
+
+        self.output = None
+        self.store = None
+        self.session = None
+        self.emitted = 0
+
+
+    async def run(self):
+        os.makedirs(self.options['state_dir'], exist_ok=True)
+        await asyncio.to_thread(self.checkpoint.load, set(login['email'] for login in self.logins))
+        self.__open_output()
+
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.options['connections']))
+        try:
+            while True:
+                started = time.monotonic()
+                await self.poll()
+                await self.save_checkpoint(True)
+                _LOGGER.info("Worker %d polled %d logins in %.1f seconds, %d readings emitted so far", self.index, len(self.logins), time.monotonic() - started, self.emitted)
+
+                if self.options['interval'] <= 0:
+                    return
+                await asyncio.sleep(max(self.options['interval'] - (time.monotonic() - started), 0))
+        finally:
+            for client in self.clients.values():
+                await client.close()
+            await self.session.close()
+            self.__close_output()
+
+
+    def __open_output(self):
+        if self.options['output'] == OUTPUT_STORE:
+            self.store = reading_store.ReadingStore(self.options['store'])
+        else:
+            os.makedirs(self.options['output_dir'], exist_ok=True)
+            self.output = open(os.path.join(self.options['output_dir'], "worker-%d.jsonl" % self.index), "a")
+
+
+    def __close_output(self):
+        if self.store != None:
+            self.store.close()
+        if self.output != None:
+            self.output.close()
+
+
+    async def poll(self):
+        semaphore = asyncio.Semaphore(self.options['concurrency'])
+
+        async def limited(login: dict):
+            async with semaphore:
+                try:
+                    await self.poll_login(login)
+                except Exception as err:
+                    _LOGGER.warning("Worker %d was unable to poll %s: %s", self.index, login['email'], err)
+
+        await asyncio.gather(*[limited(login) for login in self.logins])
+
+
+    async def __client(self, login: dict):
+        # Restored from the checkpoint where possible, which needs no requests
+        client = self.clients.get(login['email'])
+        if client != None:
+            return client
+
+        client = eonnext.EonNext(
+            self.session,
+            max_concurrency=self.options['meter_concurrency'],
+            rate_limiter=self.rate_limiter,
+            circuit_breaker=self.circuit_breaker,
+            api_url=self.options['api_url']
+        )
+        client.set_credentials(login['email'], login['password'])
+
+        state = self.checkpoint.logins.get(login['email'], {})
+        if client.restore_state(state.get("client", {})) == False:
+            if await client.login_with_username_and_password(login['email'], login['password']) == False:
+                await client.close()
+                raise transport.EonNextAuthenticationError("Unable to log in")
+
+        for meter in client.get_meters():
+            meter.synced_reading_id = state.get("synced", {}).get(meter.meter_id)
+
+        self.clients[login['email']] = client
+        return client
+
+
+    async def poll_login(self, login: dict):
+        client = await self.__client(login)
+        await client.update_meters()
+
+        for meter in client.get_meters():
+            if meter.latest_reading_id == None or meter.latest_reading_id == meter.synced_reading_id:
+                continue
+
+            batch = []
+            async for reading in meter.iter_new_readings(self.options['page_size']):
+                batch.append(reading)
+                if len(batch) >= self.options['page_size']:
+                    await self.__emit(meter, batch)
+                    batch = []
+
+            if len(batch) > 0:
+                await self.__emit(meter, batch)
+
+        self.checkpoint.logins[login['email']] = {
+            "client": client.export_state(),
+            "synced": {meter.meter_id: meter.synced_reading_id for meter in client.get_meters() if meter.synced_reading_id != None},
+            "saved": time.time()
+        }
+        await self.save_checkpoint()
+
+
+    async def save_checkpoint(self, force: bool = False):
+        async with self.checkpoint_lock:
+            if force == False and time.monotonic() - self.checkpoint_saved < CHECKPOINT_INTERVAL:
+                return
+            # Serialised here, since polling carries on changing it
+            text = json.dumps(self.checkpoint.logins)
+            await asyncio.to_thread(self.checkpoint.write, text)
+            self.checkpoint_saved = time.monotonic()
+
+
+    async def __emit(self, meter, readings: list):
+        if self.store != None:
+            self.emitted += await asyncio.to_thread(self.store.upsert_readings, meter.meter_id, readings)
+            return
+
+        rows = export.reading_rows(meter, readings)
+        for row in rows:
+            row['account'] = meter.account.account_number
+        await asyncio.to_thread(self.__write_lines, rows)
+        self.emitted += len(rows)
+
+
+    def __write_lines(self, rows: list):
+        self.output.writelines(json.dumps(row) + "\n" for row in rows)
+        self.output.flush()
+
+
+def run_worker(index: int, logins: list, options: dict):
+    """Entry point of a worker process."""
+    logging.basicConfig(level=options['log_level'], format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    try:
+        asyncio.run(FleetWorker(index, logins, options).run())
+    except KeyboardInterrupt:
+        pass
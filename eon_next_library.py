@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+import importlib
+import os
+import sys
+import types
+
+PACKAGE = "eon_next"
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "custom_components", PACKAGE)
+
+
+def load_library(module: str):
+    """Import one of the integration's Home Assistant free modules, for
+    the benchmarks and the fleet poller.
+
+    The package's __init__ needs Home Assistant, so an empty package is
+    registered in its place and the module is imported from within that."""
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [PACKAGE_PATH]
+        sys.modules[PACKAGE] = package
+
+    return importlib.import_module(PACKAGE + "." + module)